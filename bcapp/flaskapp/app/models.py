@@ -119,10 +119,61 @@ class LogReport(db.Model):
     home_page_hits = db.Column(db.Numeric)
     report = db.Column(db.String)
     log_type = db.Column(db.String)
+    unique_visitors = db.Column(db.Integer)
+    visitor_sketch = db.Column(db.String)
+    hourly_series = db.Column(db.String)
 
     def __repr__(self):
         return '<id {}>'.format(self.id)
 
+class LogRollup(db.Model):
+    __tablename__ = "log_rollups"
+    __table_args__ = (db.UniqueConstraint('domain_id', 'log_type', 'hour'),)
+    id = db.Column(db.Integer, primary_key=True)
+    domain_id = db.Column(db.Integer)
+    log_type = db.Column(db.String)
+    hour = db.Column(db.DateTime)
+    hits = db.Column(db.Integer)
+    home_page_hits = db.Column(db.Integer)
+    status = db.Column(db.String)
+    user_agents = db.Column(db.String)
+    pages = db.Column(db.String)
+    home_pages = db.Column(db.String)
+    first_date = db.Column(db.DateTime)
+    last_date = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
+
+class LogManifest(db.Model):
+    __tablename__ = "log_manifest"
+    id = db.Column(db.Integer, primary_key=True)
+    domain_id = db.Column(db.Integer, index=True)
+    s3_key = db.Column(db.String)
+    etag = db.Column(db.String)
+    log_type = db.Column(db.String)
+    ignore_settings = db.Column(db.String)
+    aggregate = db.Column(db.String)
+    # LogAggregate state version, see log_reporting_utilities.STATE_VERSION
+    state_version = db.Column(db.Integer)
+    date_analyzed = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
+
+class LogRollupFile(db.Model):
+    __tablename__ = "log_rollup_files"
+    id = db.Column(db.Integer, primary_key=True)
+    domain_id = db.Column(db.Integer, index=True)
+    s3_key = db.Column(db.String)
+    etag = db.Column(db.String)
+    ignore_settings = db.Column(db.String)
+    log_type = db.Column(db.String)
+    hourly = db.Column(db.String)
+    date_rolled_up = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
 
 class SystemSettings(db.Model):
     __tablename__ = "system_settings"
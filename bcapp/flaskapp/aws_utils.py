@@ -11,6 +11,7 @@ from dotenv import load_dotenv
 import sqlalchemy as db
 from simple_AWS.s3_functions import *
 from repo_utilities import get_final_domain
+from db_utilities import invalidate_domain_cache
 
 logger = logging.getLogger('logger')
 
@@ -179,6 +180,7 @@ def add_s3_storage(domain, s3):
 
     row.s3_storage_bucket = s3
     session.commit()
+    invalidate_domain_cache()
     
     return 'bucket_created'
 
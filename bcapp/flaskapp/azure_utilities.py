@@ -7,17 +7,27 @@ Azure Storage retrieval
 """
 import os
 import re
+import json
 import datetime
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError
 from system_utilities import get_configs
-from simple_AWS.s3_functions import *
 
 logger = logging.getLogger('logger')
 
 from azure.common.credentials import ServicePrincipalCredentials
+from azure.core.exceptions import AzureError
 from azure.mgmt.cdn import CdnManagementClient
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient, __version__
 from repo_utilities import get_final_domain
+from s3_utilities import get_s3_client, partition_key, RAW_ROOT
+from log_uploads import stream_upload
+
+# Azure CDN access logs always go to this container
+LOG_CONTAINER = "insights-logs-azurecdnaccesslog"
+DATE_MATCH = re.compile("y=[0-9]{4}\/m=[0-9]{2}\/d=[0-9]{2}\/h=[0-9]{2}\/m=[0-9]{2}")
 
 def azure_add(**kwargs):
     configs = get_configs()
@@ -98,62 +108,137 @@ def azure_add(**kwargs):
 def azure_replace(**kwargs):
     return
 
+class CopiedBlobs:
+    """
+    Record of the Azure log blobs copied to S3, kept as JSON:
+    '<bucket>/<key>' -> name and etag of the blob copied there.
+    Azure appends to the current hour's blob, so a blob that has changed
+    since it was copied (new etag) is copied again, over the same key.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as copied_file:
+                self.copied = json.load(copied_file)
+        except FileNotFoundError:
+            self.copied = {}
+        except ValueError:
+            logger.warning(f"Can't read {path}, starting again")
+            self.copied = {}
+
+    def is_copied(self, bucket, key, blob):
+        return self.copied.get(f"{bucket}/{key}") == {'name': blob.name, 'etag': blob.etag}
+
+    def mark_copied(self, bucket, key, blob):
+        with self.lock:
+            self.copied[f"{bucket}/{key}"] = {'name': blob.name, 'etag': blob.etag}
+
+    def save(self, keep):
+        """
+        Save the record of the keys in keep (the ones still in range)
+        """
+        with self.lock:
+            self.copied = {entry: blob for entry, blob in self.copied.items() if entry in keep}
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as copied_file:
+                json.dump(self.copied, copied_file)
+            os.replace(temp_path, self.path)
+
+def profile_prefixes(container, profile_name):
+    """
+    Blob name prefixes of a CDN profile's logs, one for each subscription and
+    resource group with the profile in it:
+    resourceId=/SUBSCRIPTIONS/<id>/RESOURCEGROUPS/<group>/PROVIDERS/MICROSOFT.CDN/PROFILES/<PROFILE>/
+    Found by walking the 'directories' above them, so no blobs are listed
+    """
+    prefixes = []
+    for subscription in container.walk_blobs(name_starts_with='resourceId=/SUBSCRIPTIONS/', delimiter='/'):
+        if not subscription.name.endswith('/'):
+            continue
+        for group in container.walk_blobs(name_starts_with=subscription.name + 'RESOURCEGROUPS/', delimiter='/'):
+            if group.name.endswith('/'):
+                prefixes.append(f"{group.name}PROVIDERS/MICROSOFT.CDN/PROFILES/{profile_name.upper()}/")
+    return prefixes
+
+def day_prefixes(now, range):
+    """
+    Blob name prefixes (y=/m=/d=) of the days with logs less than range days old
+    """
+    day = (now - datetime.timedelta(days=range + 1)).date()
+    prefixes = []
+    while day <= now.date():
+        prefixes.append(f"y={day:%Y}/m={day:%m}/d={day:%d}/")
+        day += datetime.timedelta(days=1)
+    return prefixes
+
 def retrieve_logs(**kwargs):
     """
-    Retrieve logs from storage
+    Copy a CDN profile's logs from Azure storage to S3, streaming each blob
+    into its upload in a pool of workers. Blobs already copied (and
+    unchanged since) are skipped, see CopiedBlobs.
+    :arg profile_name: Azure CDN profile
+    :arg range: days of logs to copy
+    :arg s3_bucket: bucket to copy them to
+    :arg domain: domain, for the partitioned key (top of the bucket if not given)
+    :arg workers: blobs copied at once, default 4
     """
     configs = get_configs()
 
     now = datetime.datetime.now()
+    profile_name = kwargs['profile_name']
+    bucket = kwargs['s3_bucket']
 
     logger.debug("Grabbing files from Azure...")
     # Create a client
-    container_name = "insights-logs-azurecdnaccesslog" # it's always called this
     container = ContainerClient.from_connection_string(
         conn_str=configs['azure_storage_conn_string'],
-        container_name=container_name)
-
-    date_match = re.compile("y=[0-9]{4}\/m=[0-9]{2}\/d=[0-9]{2}\/h=[0-9]{2}\/m=[0-9]{2}")
-    # List blobs
-    blob_list = container.list_blobs()
-    for blob in blob_list:
-    
+        container_name=LOG_CONTAINER)
+    client = get_s3_client()
+    copied = CopiedBlobs(os.path.join(configs['local_tmp'], f"azure_copied_{profile_name}.json"))
+
+    # List only the profile's blobs for the days in range
+    jobs = []
+    keep = set()
+    for profile_prefix in profile_prefixes(container, profile_name):
+        for day_prefix in day_prefixes(now, kwargs['range']):
+            for blob in container.list_blobs(name_starts_with=profile_prefix + day_prefix):
+                date_found = DATE_MATCH.search(blob.name)
+                if not date_found:
+                    continue
+                log_date = datetime.datetime.strptime(date_found.group(0), "y=%Y/m=%m/d=%d/h=%H/m=%M")
+                numdays = (now - log_date).days
+                if numdays > kwargs['range']:
+                    logger.debug(f"File {blob.name} too old!")
+                    continue
+
+                file_date = datetime.datetime.strftime(log_date, "%Y-%m-%d-%H-%M")
+                s3_filename = "Azure_CDN_log_" + profile_name + "_" + file_date + ".json"
+                if kwargs.get('domain'):
+                    s3_key = partition_key(RAW_ROOT, kwargs['domain'], log_date, s3_filename)
+                else:
+                    s3_key = s3_filename
+                keep.add(f"{bucket}/{s3_key}")
+                if copied.is_copied(bucket, s3_key, blob):
+                    continue
+                jobs.append((blob, s3_key))
+
+    def copy(job):
+        blob, s3_key = job
         try:
-            log_date_string = date_match.search(blob.name).group(0)
-            log_date = datetime.datetime.strptime(log_date_string, "y=%Y/m=%m/d=%d/h=%H/m=%M")
-            #print(f"Date: {log_date} & {log_date_string}")
-        except:
-            continue
-
-        # right profile?
-        #logger.debug(f"Profile: {kwargs['profile_name']} blob.name: {blob.name}")
-        if kwargs['profile_name'].upper() not in blob.name:
-            #logger.debug('Not right profile')
-            continue
-        
-        # TODO: Find right range of files, copy to S3
-        numdays = (now - log_date).days
-        if numdays > kwargs['range']:
-            logger.debug(f"File {blob.name} too old!")
-            continue
-        
-        file_date = datetime.datetime.strftime(log_date, "%Y-%m-%d-%H-%M")
-        s3_filename = "Azure_CDN_log_" + kwargs['profile_name'] + "_" + file_date + ".json"
-        local_path = configs['local_tmp'] + "/" + s3_filename
-        #logger.debug(f"Local path: {local_path}")
-
-        get_blob = BlobClient.from_connection_string(conn_str=configs['azure_storage_conn_string'], container_name=container_name, blob_name=blob.name)
-        with open(local_path, "wb") as tmp_blob:
-            blob_data = get_blob.download_blob()
-            blob_data.readinto(tmp_blob)
-
-        #upload to S3
-
-        s3simple = S3Simple(region_name=configs['region'], profile=configs['profile'], bucket_name=kwargs['s3_bucket'])
-        s3simple.send_file_to_s3(local_file=local_path, s3_file=s3_filename)
-
-        os.remove(local_path)
-
+            download = container.get_blob_client(blob.name).download_blob()
+            sent = stream_upload(bucket, s3_key, download.chunks(), client=client)
+        except (AzureError, BotoCoreError, ClientError) as e:
+            logger.warning(f"Couldn't copy {blob.name}: {e}")
+            return None
+        copied.mark_copied(bucket, s3_key, blob)
+        return sent
+
+    with ThreadPoolExecutor(max_workers=max(kwargs.get('workers', 4), 1)) as pool:
+        results = list(pool.map(copy, jobs))
+    copied.save(keep)
+    failed = results.count(None)
+    logger.info(f"Copied {len(jobs) - failed} Azure log files ({sum(filter(None, results))} bytes), "
+                f"{len(keep) - len(jobs)} already copied, {failed} failed")
 
     return
-
@@ -5,6 +5,8 @@ with database
 import os
 import logging
 import datetime
+import threading
+import time
 from dotenv import load_dotenv
 import sqlalchemy as db
 from system_utilities import get_configs
@@ -26,6 +28,7 @@ def set_domain_inactive(del_domain):
 
     update = domains.update().where(domains.c.domain == del_domain).values(inactive=True)
     connection.execute(update)
+    invalidate_domain_cache()
 
     logger.debug(f"Update: {update}")
 
@@ -66,10 +69,20 @@ def get_mirror_url_from_id(id):
 
     return mirror_url
 
-def get_domain_data(domain):
+# Domain settings by exact name, see get_domain_config. Read again after
+# DOMAIN_CACHE_TTL seconds, so daemons (log_shipper) see changes made by
+# other processes.
+DOMAIN_CACHE_TTL = 300
+domain_cache = {}
+# time.monotonic() of the last load, None if it needs loading
+domain_cache_loaded = None
+domain_cache_lock = threading.Lock()
+
+def load_domain_cache():
     """
-    Get domain data
+    Read every domain's settings into the cache
     """
+    global domain_cache_loaded
     load_dotenv()
 
     engine = db.create_engine(os.environ['DATABASE_URL'])
@@ -78,27 +91,80 @@ def get_domain_data(domain):
 
     domains = db.Table('domains', metadata, autoload=True, autoload_with=engine)
 
-    ## Get domain id
     query = db.select([domains])
     result = connection.execute(query).fetchall()
-    
-    domain_data = {
-        'id': False
-    }
+    connection.close()
+    engine.dispose()
+
+    configs = {}
     for entry in result:
         d_id, domain_fetched, ext_ignore, paths_ignore, s3_bucket, azure_profile, inactive = entry
-        if domain_fetched in domain:
-            domain_data['id'] = d_id
-            domain_data['ext_ignore'] = ext_ignore
-            domain_data['paths_ignore'] = paths_ignore
-            domain_data['s3_bucket'] = s3_bucket
-            domain_data['azure_profile'] = azure_profile
-            domain_data['inactive'] = inactive
-    
-    if not domain_data['id']: 
-        domain_data = False
+        configs[domain_fetched] = {
+            'id': d_id,
+            'ext_ignore': ext_ignore,
+            'paths_ignore': paths_ignore,
+            's3_bucket': s3_bucket,
+            'azure_profile': azure_profile,
+            'inactive': inactive
+        }
+    domain_cache.clear()
+    domain_cache.update(configs)
+    domain_cache_loaded = time.monotonic()
+    return
+
+def domain_cache_expired():
+    return domain_cache_loaded is None or time.monotonic() - domain_cache_loaded > DOMAIN_CACHE_TTL
+
+def invalidate_domain_cache():
+    """
+    Forget cached domain settings, so they are read again on next use.
+    Call after changing a domain.
+    """
+    global domain_cache_loaded
+    with domain_cache_lock:
+        domain_cache.clear()
+        domain_cache_loaded = None
+    return
+
+def get_domain_config(domain):
+    """
+    Cached settings for a domain, by exact name
+    :returns dict with id, ext_ignore, paths_ignore, s3_bucket, azure_profile
+        and inactive, or False if there's no such domain
+    """
+    with domain_cache_lock:
+        if domain_cache_expired():
+            load_domain_cache()
+        config = domain_cache.get(domain)
+    if not config:
+        return False
+    return dict(config)
+
+def get_domain_configs():
+    """
+    Cached settings for every domain
+    :returns dict of domain name to settings, see get_domain_config
+    """
+    with domain_cache_lock:
+        if domain_cache_expired():
+            load_domain_cache()
+        return {name: dict(config) for name, config in domain_cache.items()}
 
-    return domain_data
+def get_domain_data(domain):
+    """
+    Get domain data
+    Exact names come straight from the cache; anything else (a URL, say)
+    falls back to the last domain whose name is contained in it.
+    """
+    domain_data = get_domain_config(domain)
+    if domain_data:
+        return domain_data
+
+    with domain_cache_lock:
+        matches = [config for name, config in domain_cache.items() if name in domain]
+    if not matches:
+        return False
+    return dict(matches[-1])
 
 def report_save(**kwargs):
     """
@@ -124,7 +190,10 @@ def report_save(**kwargs):
             'home_page_hits':kwargs['home_page_hits'],
             'first_date_of_log':kwargs['first_date_of_log'],
             'last_date_of_log':kwargs['last_date_of_log'],
-            'log_type':kwargs['log_type']
+            'log_type':kwargs['log_type'],
+            'unique_visitors':kwargs.get('unique_visitors'),
+            'visitor_sketch':kwargs.get('visitor_sketch'),
+            'hourly_series':kwargs.get('hourly_series')
         }
     insert = log_reports.insert().values(**report_data)
     result = connection.execute(insert)
@@ -134,6 +203,201 @@ def report_save(**kwargs):
 
     return
 
+class LogDatabase:
+    """
+    One connection to the log analysis tables (log_manifest, log_rollups
+    and log_rollup_files), for all of a domain's files, instead of an
+    engine per call. Close it when done, or use it in a with block.
+    """
+    def __init__(self):
+        load_dotenv()
+        self.engine = db.create_engine(os.environ['DATABASE_URL'])
+        self.connection = self.engine.connect()
+        metadata = db.MetaData()
+        self.manifest = db.Table('log_manifest', metadata, autoload=True, autoload_with=self.engine)
+        self.rollups = db.Table('log_rollups', metadata, autoload=True, autoload_with=self.engine)
+        self.rollup_files = db.Table('log_rollup_files', metadata, autoload=True, autoload_with=self.engine)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+        self.engine.dispose()
+
+    def transaction(self):
+        """
+        Transaction on the connection, for a with block
+        """
+        return self.connection.begin()
+
+    def manifest_entries(self, domain_id):
+        """
+        The manifest of log files already analyzed for a domain, without
+        their aggregates (see manifest_aggregate)
+        :returns dict keyed by S3 key, with etag, log_type, ignore_settings,
+            state_version (0 for entries saved before it was kept) and has_aggregate
+        """
+        log_manifest = self.manifest
+        query = db.select([log_manifest.c.s3_key, log_manifest.c.etag, log_manifest.c.log_type,
+                           log_manifest.c.ignore_settings, log_manifest.c.state_version,
+                           (log_manifest.c.aggregate != '').label('has_aggregate')]).where(
+            log_manifest.c.domain_id == domain_id)
+        return {row.s3_key: {'etag': row.etag, 'log_type': row.log_type,
+                             'ignore_settings': row.ignore_settings, 'state_version': row.state_version or 0,
+                             'has_aggregate': bool(row.has_aggregate)}
+                for row in self.connection.execute(query).fetchall()}
+
+    def manifest_aggregate(self, domain_id, s3_key):
+        """
+        The saved aggregate of one analyzed file ('' if it isn't a log file, None if there's no entry)
+        """
+        log_manifest = self.manifest
+        query = db.select([log_manifest.c.aggregate]).where(log_manifest.c.domain_id == domain_id).where(
+            log_manifest.c.s3_key == s3_key)
+        row = self.connection.execute(query).fetchone()
+        return row[0] if row else None
+
+    def save_manifest_entry(self, domain_id, s3_key, entry):
+        """
+        Save (or replace) the manifest entry of an analyzed file
+        :arg entry: dict with etag, log_type, ignore_settings, state_version and aggregate
+        """
+        log_manifest = self.manifest
+        self.connection.execute(log_manifest.delete().where(log_manifest.c.domain_id == domain_id).where(
+            log_manifest.c.s3_key == s3_key))
+        self.connection.execute(log_manifest.insert().values(
+            domain_id=domain_id,
+            s3_key=s3_key,
+            etag=entry['etag'],
+            log_type=entry['log_type'],
+            ignore_settings=entry['ignore_settings'],
+            aggregate=entry['aggregate'],
+            state_version=entry['state_version'],
+            date_analyzed=datetime.datetime.now()
+        ))
+
+    def prune_manifest(self, domain_id, keep_keys):
+        """
+        Drop manifest entries for files that are no longer in the analysis range.
+        Their rollup markers (log_rollup_files) are kept.
+        """
+        log_manifest = self.manifest
+        query = db.select([log_manifest.c.s3_key]).where(log_manifest.c.domain_id == domain_id)
+        delete_keys = set(row[0] for row in self.connection.execute(query).fetchall()) - set(keep_keys)
+        if delete_keys:
+            with self.connection.begin():
+                self.connection.execute(log_manifest.delete().where(log_manifest.c.domain_id == domain_id).where(
+                    log_manifest.c.s3_key.in_(list(delete_keys))))
+
+    def rollup_file(self, domain_id, s3_key):
+        """
+        What a file last added to the rollups
+        :returns dict with etag, ignore_settings, log_type and hourly (JSON), or None
+        """
+        rollup_files = self.rollup_files
+        query = db.select([rollup_files]).where(rollup_files.c.domain_id == domain_id).where(
+            rollup_files.c.s3_key == s3_key)
+        row = self.connection.execute(query).fetchone()
+        return dict(row) if row else None
+
+    def save_rollup_file(self, domain_id, s3_key, etag, ignore_settings, log_type, hourly):
+        """
+        Record what a file added to the rollups
+        :arg hourly: JSON of the hourly counts added
+        """
+        rollup_files = self.rollup_files
+        self.connection.execute(rollup_files.delete().where(rollup_files.c.domain_id == domain_id).where(
+            rollup_files.c.s3_key == s3_key))
+        self.connection.execute(rollup_files.insert().values(
+            domain_id=domain_id,
+            s3_key=s3_key,
+            etag=etag,
+            ignore_settings=ignore_settings,
+            log_type=log_type,
+            hourly=hourly,
+            date_rolled_up=datetime.datetime.now()
+        ))
+
+    def get_rollups(self, domain_id, log_type, hours):
+        """
+        Hourly log rollups of a domain and log type for some hours
+        :returns list of dicts, one per hour
+        """
+        log_rollups = self.rollups
+        query = db.select([log_rollups]).where(log_rollups.c.domain_id == domain_id).where(
+            log_rollups.c.log_type == log_type).where(log_rollups.c.hour.in_(hours))
+        return [dict(row) for row in self.connection.execute(query).fetchall()]
+
+    def save_rollups(self, domain_id, log_type, rollups):
+        """
+        Save hourly log rollups, replacing any rows for the same hours.
+        Call it in a transaction.
+        :arg rollups: list of dicts with hour, hits, home_page_hits, status,
+            user_agents, pages, home_pages, first_date and last_date
+        """
+        if not rollups:
+            return
+        log_rollups = self.rollups
+        self.connection.execute(log_rollups.delete().where(log_rollups.c.domain_id == domain_id).where(
+            log_rollups.c.log_type == log_type).where(
+            log_rollups.c.hour.in_([rollup['hour'] for rollup in rollups])))
+        for rollup in rollups:
+            self.connection.execute(log_rollups.insert().values(domain_id=domain_id, log_type=log_type, **rollup))
+
+def rename_log_manifest_keys(domain_id, renames):
+    """
+    Point manifest entries and rollup markers at new S3 keys, when log files are moved
+    :arg renames: dict of old S3 key to new S3 key
+    """
+    if not renames:
+        return True
+    load_dotenv()
+
+    engine = db.create_engine(os.environ['DATABASE_URL'])
+    connection = engine.connect()
+    metadata = db.MetaData()
+    log_manifest = db.Table('log_manifest', metadata, autoload=True, autoload_with=engine)
+    rollup_files = db.Table('log_rollup_files', metadata, autoload=True, autoload_with=engine)
+
+    with connection.begin():
+        for old_key, new_key in renames.items():
+            for table in (log_manifest, rollup_files):
+                update = table.update().where(table.c.domain_id == domain_id).where(
+                    table.c.s3_key == old_key).values(s3_key=new_key)
+                connection.execute(update)
+
+    return True
+
+def get_log_rollups(domain_id, log_type, start=None, end=None, hours=None):
+    """
+    Get hourly log rollups for a domain and log type
+    :arg start, end: optional datetimes bounding the hours (end is exclusive)
+    :arg hours: optional list of specific hours
+    :returns list of dicts, one per hour
+    """
+    load_dotenv()
+
+    engine = db.create_engine(os.environ['DATABASE_URL'])
+    connection = engine.connect()
+    metadata = db.MetaData()
+    log_rollups = db.Table('log_rollups', metadata, autoload=True, autoload_with=engine)
+
+    query = db.select([log_rollups]).where(log_rollups.c.domain_id == domain_id).where(
+        log_rollups.c.log_type == log_type)
+    if start:
+        query = query.where(log_rollups.c.hour >= start)
+    if end:
+        query = query.where(log_rollups.c.hour < end)
+    if hours is not None:
+        query = query.where(log_rollups.c.hour.in_(hours))
+    query = query.order_by(log_rollups.c.hour)
+
+    return [dict(row) for row in connection.execute(query).fetchall()]
+
 def cross_check(domain):
     """
     Making sure all domain alternatives have database entry
@@ -0,0 +1,467 @@
+"""
+Benchmarks for the log analysis pipeline
+
+The S3 benchmarks run against a local moto bucket (pip install moto),
+never against real buckets. The suite command times each stage of the
+analysis on synthetic logs and writes the results as JSON, so runs on
+different versions can be compared.
+"""
+import os
+import sys
+import gc
+import gzip
+import json
+import time
+import platform
+import itertools
+import tempfile
+import random
+import datetime
+import functools
+import logging
+import click
+import boto3
+from log_reporting_utilities import analyze_file, read_log_lines, output, LogAggregate
+from log_parsers import get_parser, sniff_parser, datetime_to_epoch
+from log_columns import ColumnBuffer
+from log_filters import get_ignore_filter
+from s3_utilities import open_s3_object, prefetch
+
+logger = logging.getLogger('logger')
+
+BENCHMARK_DOMAIN = {
+    'id': 1,
+    'paths_ignore': None,
+    'ext_ignore': None
+}
+
+# Settings for the suite's filter stage, matching some of the synthetic pages
+BENCHMARK_FILTERED_DOMAIN = {
+    'id': 1,
+    'paths_ignore': '/static,/wp-admin',
+    'ext_ignore': '.png,.ico'
+}
+
+SUITE_STAGES = ('read', 'parse', 'filter', 'aggregate', 'render')
+SUITE_FORMAT = 1
+
+# Sizes and Zipf exponents of the synthetic populations: a few pages,
+# agents and IPs get most of the hits, with a long tail of rare ones
+SYNTHETIC_PAGES = (20000, 1.1)
+SYNTHETIC_AGENTS = (500, 1.3)
+SYNTHETIC_IPS = (50000, 0.9)
+SYNTHETIC_STATUSES = ((200, 80), (304, 8), (301, 4), (404, 6), (500, 2))
+
+def zipf_sampler(rand, population, exponent):
+    """
+    Draws from population, the item at rank k (from 1) weighted 1 / k ** exponent
+    :returns function of k, giving a list of k items
+    """
+    cum_weights = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, len(population) + 1)))
+    return lambda k: rand.choices(population, cum_weights=cum_weights, k=k)
+
+def synthetic_page(rank):
+    """
+    Page path for a popularity rank: the home page, then a mix of
+    articles and static files (for the ignore settings to skip)
+    """
+    if rank == 0:
+        return '/'
+    if rank % 7 == 0:
+        return f"/static/app{rank}.css"
+    if rank % 11 == 0:
+        return f"/images/{rank}.png"
+    return f"/articles/{rank}.html"
+
+def synthetic_agent(rank):
+    return f"Mozilla/5.0 (X11; Linux x86_64; rv:{rank % 100}.0) Gecko/20100101 Firefox/{rank}.0"
+
+def synthetic_ip(rank):
+    return f"10.{rank >> 16 & 255}.{rank >> 8 & 255}.{rank & 255}"
+
+def format_nginx(when, ip, page, status, agent):
+    return f'{ip} - - [{when:%d/%b/%Y:%H:%M:%S} +0000] "GET {page} HTTP/1.1" {status} 512 "-" "{agent}"'
+
+def format_cloudfront(when, ip, page, status, agent):
+    return '\t'.join((f"{when:%Y-%m-%d}", f"{when:%H:%M:%S}", 'IAD89-C1', '512', ip, 'GET',
+                      'd111111abcdef8.cloudfront.net', page, str(status), '-', agent.replace(' ', '%20'),
+                      '-', '-', 'Miss', 'x', 'example.com', 'https', '300', '0.001'))
+
+def format_fastly(when, ip, page, status, agent):
+    return (f'<134>{when:%Y-%m-%dT%H:%M:%S}Z cache-iad2120 s3-logs[123456]: example.com {ip} '
+            f'[{when:%d/%b/%Y:%H:%M:%S} +0000] GET "GET {page} HTTP/1.1" {status}')
+
+def format_azure(when, ip, page, status, agent):
+    return json.dumps({
+        'time': f"{when:%Y-%m-%dT%H:%M:%S}.0000000Z",
+        'resourceId': '/SUBSCRIPTIONS/X/RESOURCEGROUPS/X/PROVIDERS/MICROSOFT.CDN/PROFILES/BENCHMARK',
+        'category': 'AzureCdnAccessLog',
+        'properties': {
+            'requestUri': f"https://example.azureedge.net:443{page}",
+            'httpStatusCode': str(status),
+            'userAgent': agent,
+            'clientIp': ip
+        }
+    })
+
+SYNTHETIC_FORMATS = {
+    'nginx': format_nginx,
+    'cloudfront': format_cloudfront,
+    'fastly': format_fastly,
+    'azure': format_azure
+}
+
+def synthetic_lines(log_type, num_lines, seed=0, batch=10000):
+    """
+    Yields the lines of a deterministic log in one of the SYNTHETIC_FORMATS,
+    with Zipf-distributed pages, user agents and IPs, and about one
+    line a second from the start of 2020
+    """
+    rand = random.Random(seed)
+    pages = zipf_sampler(rand, [synthetic_page(rank) for rank in range(SYNTHETIC_PAGES[0])], SYNTHETIC_PAGES[1])
+    agents = zipf_sampler(rand, [synthetic_agent(rank) for rank in range(SYNTHETIC_AGENTS[0])], SYNTHETIC_AGENTS[1])
+    ips = zipf_sampler(rand, [synthetic_ip(rank) for rank in range(SYNTHETIC_IPS[0])], SYNTHETIC_IPS[1])
+    status_values, status_weights = zip(*SYNTHETIC_STATUSES)
+    format_line = SYNTHETIC_FORMATS[log_type]
+    if log_type == 'cloudfront':
+        yield '#Version: 1.0'
+        yield ('#Fields: date time x-edge-location sc-bytes c-ip cs-method cs(Host) cs-uri-stem sc-status '
+               'cs(Referer) cs(User-Agent) cs-uri-query cs(Cookie) x-edge-result-type x-edge-request-id '
+               'x-host-header cs-protocol cs-bytes time-taken')
+    when = datetime.datetime(2020, 1, 1)
+    for done in range(0, num_lines, batch):
+        size = min(batch, num_lines - done)
+        statuses = rand.choices(status_values, weights=status_weights, k=size)
+        for page, agent, ip, status in zip(pages(size), agents(size), ips(size), statuses):
+            when += datetime.timedelta(seconds=rand.randint(0, 2))
+            yield format_line(when, ip, page, status, agent)
+
+def synthetic_log(log_type, num_lines, seed=0):
+    """
+    A deterministic log (see synthetic_lines), as text
+    """
+    return '\n'.join(synthetic_lines(log_type, num_lines, seed)) + '\n'
+
+def moto_s3():
+    """
+    Get moto's S3 mock, whichever version is installed
+    """
+    try:
+        from moto import mock_aws
+        return mock_aws()
+    except ImportError:
+        pass
+    try:
+        from moto import mock_s3
+        return mock_s3()
+    except ImportError:
+        raise click.ClickException("This benchmark needs moto: pip install moto")
+
+def reset_peak_rss():
+    """
+    Start a new peak resident memory measurement. Only Linux can do this,
+    elsewhere peak_rss stays the peak of the whole process.
+    :returns: whether the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as refs:
+            refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss():
+    """
+    Peak resident memory in bytes, since reset_peak_rss
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def measure_stage(results, stage, lines, function, *args):
+    """
+    Run one stage of the suite, recording its time and peak memory
+    :returns: what the stage returns
+    """
+    gc.collect()
+    scoped = reset_peak_rss()
+    start = time.perf_counter()
+    value = function(*args)
+    seconds = time.perf_counter() - start
+    results[stage] = {
+        'lines': lines,
+        'seconds': round(seconds, 4),
+        'lines_per_sec': round(lines / seconds) if seconds else None,
+        'peak_rss_mb': round(peak_rss() / (1 << 20), 1),
+        'peak_rss_scope': 'stage' if scoped else 'process'
+    }
+    return value
+
+def run_suite(log_type, lines, seed=0, engine='dict', compress=False):
+    """
+    Time each stage of analyzing a synthetic log of one type, as analyze_file does it:
+    read (decompress and split lines), parse (fields and timestamps),
+    filter (the domain's ignore settings), aggregate (count), render (report text)
+    :returns: dict of stage to measurements
+    """
+    results = {}
+    suffix = '.log.gz' if compress else '.log'
+    with tempfile.NamedTemporaryFile(suffix=suffix) as log_file:
+        with (gzip.open(log_file.name, 'wt', compresslevel=1) if compress else open(log_file.name, 'w')) as log_text:
+            for line in synthetic_lines(log_type, lines, seed):
+                log_text.write(line + '\n')
+        log_lines = measure_stage(results, 'read', lines, lambda: list(read_log_lines(log_file.name)))
+
+    parser = sniff_parser(log_lines[0])
+    assert parser.log_type == log_type
+    parser.minute_cache.clear()
+
+    def parse():
+        parse_line = parser.parse
+        parse_timestamp = parser.parse_timestamp
+        parsed = []
+        for line in log_lines:
+            if not line or line[0] == '#':
+                continue
+            log_data = parse_line(line)
+            if not log_data or 'page_visited' not in log_data:
+                continue
+            log_time = parse_timestamp(log_data['datetime']) if 'datetime' in log_data else False
+            parsed.append((log_data, log_time))
+        return parsed
+    parsed = measure_stage(results, 'parse', len(log_lines), parse)
+    del log_lines
+
+    def filter_pages():
+        domain_data = BENCHMARK_FILTERED_DOMAIN
+        ignore = get_ignore_filter(domain_data['paths_ignore'], domain_data['ext_ignore']).ignore
+        return [(log_data, log_time) for log_data, log_time in parsed if not ignore(log_data['page_visited'])]
+    kept = measure_stage(results, 'filter', len(parsed), filter_pages)
+    del parsed
+
+    def aggregate():
+        log_aggregate = LogAggregate(log_type)
+        if engine == 'columnar':
+            columns = ColumnBuffer(log_aggregate)
+            add = columns.add
+        else:
+            add = log_aggregate.add
+        for log_data, log_time in kept:
+            add(log_data, log_time)
+        if engine == 'columnar':
+            columns.flush()
+        return log_aggregate
+    log_aggregate = measure_stage(results, 'aggregate', len(kept), aggregate)
+
+    def render():
+        return output(domain='benchmark', data=log_aggregate.to_dict(), percent=1, num=30)
+    measure_stage(results, 'render', log_aggregate.hits, render)
+    return results
+
+def suite_environment():
+    """
+    What the results were measured on, to tell runs apart
+    """
+    try:
+        import subprocess
+        revision = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True,
+                                  text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        revision = ''
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        'revision': revision or None,
+        'python': platform.python_version(),
+        'numpy': numpy_version,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    }
+
+@click.group()
+def benchmark():
+    """
+    Log pipeline benchmarks
+    """
+    pass
+
+@benchmark.command()
+@click.option('--files', type=int, help="Number of log files in the bucket. Default is 20", default=20)
+@click.option('--lines', type=int, help="Lines per log file. Default is 50000", default=50000)
+@click.option('--depth', type=int, help="Prefetch depth. Default is 4", default=4)
+@click.option('--latency-ms', type=int, help="Simulated latency per S3 request. Default is 50", default=50)
+def pipeline(files, lines, depth, latency_ms):
+    """
+    Download-then-parse against the prefetching pipeline, on a moto bucket
+    """
+    bucket = 'log-benchmark'
+    with moto_s3():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=bucket)
+        keys = []
+        for i in range(files):
+            key = f"RawLogFile_benchmark_{i}.log.gz"
+            body = gzip.compress(synthetic_log('nginx', lines, seed=i).encode())
+            client.put_object(Bucket=bucket, Key=key, Body=body)
+            keys.append(key)
+
+        def fetch(key, max_buffer=0):
+            time.sleep(latency_ms / 1000)
+            return open_s3_object(bucket, key, max_buffer=max_buffer, client=client)
+
+        def parse(key, log_stream):
+            try:
+                aggregate, log_type = analyze_file(read_log_lines(key, log_stream), 'benchmark', BENCHMARK_DOMAIN)
+            finally:
+                log_stream.close()
+            return aggregate.hits
+
+        start = time.perf_counter()
+        hits = 0
+        for key in keys:
+            hits += parse(key, fetch(key))
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pipelined_hits = 0
+        fetch_ahead = functools.partial(fetch, max_buffer=64 * 1024 * 1024)
+        for key, future in prefetch(fetch_ahead, keys, depth):
+            pipelined_hits += parse(key, future.result())
+        pipelined = time.perf_counter() - start
+
+    assert hits == pipelined_hits
+    print(f"Sequential: {sequential:.2f}s ({hits / sequential:.0f} lines/s)")
+    print(f"Pipelined (depth {depth}): {pipelined:.2f}s ({hits / pipelined:.0f} lines/s)")
+
+@benchmark.command()
+@click.option('--lines', type=int, help="Timestamps per log format. Default is 200000", default=200000)
+def timestamps(lines):
+    """
+    strptime against the memoized fixed-offset timestamp parsers
+    """
+    start = datetime.datetime(2020, 1, 1)
+    samples = {
+        'nginx': '%d/%b/%Y:%H:%M:%S',
+        'cloudfront': '%Y-%m-%d\t%H:%M:%S',
+        'fastly': '[%d/%b/%Y:%H:%M:%S',
+        'azure': '%Y-%m-%dT%H:%M:%S.0000000Z'
+    }
+    for log_type, time_format in samples.items():
+        parser = get_parser(log_type)
+        values = [(start + datetime.timedelta(seconds=i)).strftime(time_format) for i in range(lines)]
+
+        began = time.perf_counter()
+        expected = [datetime_to_epoch(parser.parse_datetime(value)) for value in values]
+        slow = time.perf_counter() - began
+
+        parser.minute_cache.clear()
+        began = time.perf_counter()
+        fast_values = [parser.parse_timestamp(value) for value in values]
+        fast = time.perf_counter() - began
+
+        assert fast_values == expected
+        print(f"{log_type}: strptime {lines / slow:.0f}/s, parse_timestamp {lines / fast:.0f}/s ({slow / fast:.1f}x)")
+
+@benchmark.command()
+@click.option('--lines', type=int, help="Lines of synthetic log. Default is 10000000", default=10000000)
+def engines(lines):
+    """
+    The dict engine against the columnar (numpy) engine, on the same log
+    """
+    with tempfile.NamedTemporaryFile(suffix='.log.gz') as log_file:
+        with gzip.open(log_file.name, 'wt', compresslevel=1) as log_text:
+            for line in synthetic_lines('nginx', lines):
+                log_text.write(line + '\n')
+
+        results = {}
+        for engine in ('dict', 'columnar'):
+            start = time.perf_counter()
+            aggregate, log_type = analyze_file(read_log_lines(log_file.name), 'benchmark', BENCHMARK_DOMAIN,
+                                               hourly=True, engine=engine)
+            results[engine] = (time.perf_counter() - start, aggregate)
+
+    dict_time, dict_aggregate = results['dict']
+    columnar_time, columnar_aggregate = results['columnar']
+    assert dict_aggregate.to_dict() == columnar_aggregate.to_dict()
+    print(f"dict: {dict_time:.2f}s ({lines / dict_time:.0f} lines/s)")
+    print(f"columnar: {columnar_time:.2f}s ({lines / columnar_time:.0f} lines/s)")
+
+@benchmark.command()
+@click.option('--lines', type=int, help="Lines of synthetic log per format. Default is 1000000", default=1000000)
+@click.option('--log-type', 'log_types', type=click.Choice(list(SYNTHETIC_FORMATS)), multiple=True,
+              help="Log format to run (repeatable). Default is all of them")
+@click.option('--engine', type=click.Choice(['dict', 'columnar']), help="Counting engine. Default is dict", default='dict')
+@click.option('--compress', is_flag=True, help="Read the synthetic logs gzipped", default=False)
+@click.option('--seed', type=int, help="Seed for the synthetic logs. Default is 0", default=0)
+@click.option('--repeat', type=int, help="Runs per format, keeping each stage's fastest. Default is 3", default=3)
+@click.option('--output', 'output_file', type=click.Path(), help="Write the results as JSON to this file", default=None)
+def suite(lines, log_types, engine, compress, seed, repeat, output_file):
+    """
+    Lines/sec and peak memory for each stage of the analysis, for each log format
+    """
+    results = {
+        'format': SUITE_FORMAT,
+        'environment': suite_environment(),
+        'settings': {'lines': lines, 'engine': engine, 'compress': compress, 'seed': seed, 'repeat': repeat},
+        'results': {}
+    }
+    for log_type in (log_types or SYNTHETIC_FORMATS):
+        stages = {}
+        for run in range(max(repeat, 1)):
+            for stage, measured in run_suite(log_type, lines, seed, engine, compress).items():
+                if stage not in stages or measured['seconds'] < stages[stage]['seconds']:
+                    stages[stage] = measured
+        results['results'][log_type] = stages
+        for stage in SUITE_STAGES:
+            measured = stages[stage]
+            print(f"{log_type:>10} {stage:>9}: {measured['lines_per_sec'] or 0:>10} lines/s "
+                  f"{measured['peak_rss_mb']:>8} MB peak")
+    if output_file:
+        with open(output_file, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+
+@benchmark.command()
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--threshold', type=float, help="Slowdown (percent) reported as a regression. Default is 10", default=10.0)
+def compare(baseline, current, threshold):
+    """
+    Compare two suite results files, stage by stage.
+    Exits with an error if any stage slowed down by more than the threshold.
+    """
+    before = json.load(baseline)
+    after = json.load(current)
+    if before['settings'] != after['settings']:
+        logger.warning(f"Different settings: {before['settings']} and {after['settings']}")
+    regressions = []
+    for log_type, stages in after['results'].items():
+        for stage in SUITE_STAGES:
+            old = before['results'].get(log_type, {}).get(stage)
+            new = stages.get(stage)
+            if not old or not new or not old['lines_per_sec'] or not new['lines_per_sec']:
+                continue
+            change = (new['lines_per_sec'] / old['lines_per_sec'] - 1) * 100
+            memory = new['peak_rss_mb'] - old['peak_rss_mb']
+            flag = ''
+            if change < -threshold:
+                flag = ' REGRESSION'
+                regressions.append(f"{log_type} {stage}")
+            print(f"{log_type:>10} {stage:>9}: {old['lines_per_sec']:>10} -> {new['lines_per_sec']:>10} lines/s "
+                  f"({change:+.1f}%), peak {memory:+.1f} MB{flag}")
+    if regressions:
+        raise click.ClickException(f"Slower by more than {threshold}%: {', '.join(regressions)}")
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,154 @@
+"""
+Columnar engine for log reporting
+
+Parsed lines go into column buffers (dictionary-encoded codes for status,
+page, agent and IP, epoch seconds as int64) and are counted with numpy
+a chunk at a time, instead of bumping several dicts per line.
+The counts come out the same as LogAggregate.add, first-seen order included.
+"""
+from array import array
+import numpy as np
+from log_parsers import status_number
+
+# Lines buffered before they are counted into the aggregate
+CHUNK_SIZE = 1 << 20
+
+class ColumnBuffer:
+    """
+    Buffers parsed lines for an aggregate, and counts them into it in chunks.
+    Use it in place of aggregate.add, and call flush() at the end.
+    """
+    def __init__(self, aggregate, chunk_size=CHUNK_SIZE):
+        self.aggregate = aggregate
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.times = array('q')
+        self.columns = {name: array('i') for name in ('status', 'user_agent', 'pages_visited', 'visitor_ips')}
+        # value -> code, codes in first-seen order
+        self.codes = {name: {} for name in self.columns}
+
+    def add(self, log_data, log_time):
+        """
+        Buffer a parsed line, same arguments as LogAggregate.add
+        """
+        self.hits += 1
+        if log_time is False or 'status' not in log_data:
+            return
+        self.times.append(log_time)
+        for name, key in (('status', 'status'), ('user_agent', 'user_agent'), ('pages_visited', 'page_visited')):
+            codes = self.codes[name]
+            value = log_data[key]
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(codes)
+            self.columns[name].append(code)
+        if self.aggregate.track_ips and 'ip' in log_data:
+            codes = self.codes['visitor_ips']
+            code = codes.get(log_data['ip'])
+            if code is None:
+                code = codes[log_data['ip']] = len(codes)
+            self.columns['visitor_ips'].append(code)
+        else:
+            self.columns['visitor_ips'].append(-1)
+        if len(self.times) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Count the buffered lines into the aggregate
+        """
+        if self.hits:
+            self.aggregate.merge(self.chunk_aggregate())
+        self.reset()
+        return self.aggregate
+
+    def chunk_aggregate(self):
+        """
+        LogAggregate of the buffered lines
+        """
+        target = self.aggregate
+        LogAggregate = type(target)
+        chunk = LogAggregate(target.log_type, hourly=target.hourly is not None, track_ips=target.track_ips)
+        chunk.hits = self.hits
+        if not self.times:
+            return chunk
+
+        times = np.frombuffer(self.times, dtype=np.int64)
+        columns = {name: np.frombuffer(column, dtype=np.int32) for name, column in self.columns.items()}
+        values = {name: list(codes) for name, codes in self.codes.items()}
+        pages = values['pages_visited']
+        home_codes = np.array([LogAggregate.is_home_page(page) for page in pages], dtype=bool)
+        home = home_codes[columns['pages_visited']]
+
+        chunk.earliest = int(times.min())
+        chunk.latest = int(times.max())
+        for name in ('status', 'user_agent', 'pages_visited'):
+            counts = np.bincount(columns[name], minlength=len(values[name]))
+            setattr(chunk, name, dict(zip(values[name], counts.tolist())))
+        chunk.home_pages = {page: number for page, number, is_home
+                            in zip(pages, chunk.pages_visited.values(), home_codes) if is_home}
+        if target.track_ips:
+            ips = columns['visitor_ips']
+            counts = np.bincount(ips[ips >= 0], minlength=len(values['visitor_ips']))
+            chunk.visitor_ips = dict(zip(values['visitor_ips'], counts.tolist()))
+            chunk.visitors.update(values['visitor_ips'])
+        if chunk.series is not None:
+            statuses = np.array([status_number(status) for status in values['status']], dtype=np.uint16)
+            hours = times // 3600
+            start = int(hours.min())
+            offsets = hours - start
+            length = int(offsets.max()) + 1
+            chunk.series.add_bins(start,
+                                  np.bincount(offsets, minlength=length),
+                                  np.bincount(offsets[statuses[columns['status']] >= 400], minlength=length),
+                                  np.bincount(offsets[home], minlength=length))
+        if chunk.hourly is not None:
+            self.hourly_aggregates(chunk, times, columns, values, home_codes)
+        return chunk
+
+    def hourly_aggregates(self, chunk, times, columns, values, home_codes):
+        """
+        Fill in chunk.hourly, with hours and values in first-seen order like LogAggregate.add
+        """
+        LogAggregate = type(chunk)
+        hours, first, hour_index = np.unique(times - times % 3600, return_index=True, return_inverse=True)
+        order = np.argsort(first, kind='stable')
+        rank = np.empty(len(hours), dtype=np.int64)
+        rank[order] = np.arange(len(hours))
+        # each line's hour, numbered in first-seen order
+        line_hours = rank[hour_index.reshape(-1)]
+        hour_aggregates = []
+        for position in order:
+            hour_aggregate = LogAggregate(chunk.log_type, track_ips=False)
+            chunk.hourly[int(hours[position])] = hour_aggregate
+            hour_aggregates.append(hour_aggregate)
+
+        hits = np.bincount(line_hours, minlength=len(hours))
+        earliest = np.full(len(hours), np.iinfo(np.int64).max)
+        latest = np.full(len(hours), np.iinfo(np.int64).min)
+        np.minimum.at(earliest, line_hours, times)
+        np.maximum.at(latest, line_hours, times)
+        for number, hour_aggregate in enumerate(hour_aggregates):
+            hour_aggregate.hits = int(hits[number])
+            hour_aggregate.earliest = int(earliest[number])
+            hour_aggregate.latest = int(latest[number])
+
+        for name in ('status', 'user_agent', 'pages_visited'):
+            size = len(values[name])
+            keys, first, counts = np.unique(line_hours * size + columns[name], return_index=True, return_counts=True)
+            order = np.argsort(first, kind='stable')
+            keys = keys[order]
+            counts = counts[order].tolist()
+            numbers = (keys // size).tolist()
+            codes = (keys % size).tolist()
+            targets = [getattr(hour_aggregate, name) for hour_aggregate in hour_aggregates]
+            names = values[name]
+            for number, code, count in zip(numbers, codes, counts):
+                targets[number][names[code]] = count
+            if name == 'pages_visited':
+                for number, code, count in zip(numbers, codes, counts):
+                    if home_codes[code]:
+                        hour_aggregates[number].home_pages[names[code]] = count
@@ -0,0 +1,83 @@
+"""
+Page filters for log reporting
+
+A domain's paths_ignore and ext_ignore settings are compiled once into an
+IgnoreFilter, so checking a page costs the same however long the lists are.
+"""
+import re
+import functools
+
+def split_setting(setting):
+    """
+    Comma separated domain setting to a list, dropping blanks
+    """
+    if not setting:
+        return []
+    return [item.strip() for item in setting.split(',') if item.strip()]
+
+def prefix_trie(prefixes):
+    """
+    Build a nested dict trie of strings. '' marks the end of a prefix.
+    """
+    trie = {}
+    for prefix in prefixes:
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return trie
+
+def trie_pattern(node):
+    """
+    Regex for a trie, where any prefix ending stops the match.
+    Each character is only tried once, however many prefixes share it.
+    """
+    if '' in node:
+        # a shorter prefix already matches everything below here
+        return ''
+    branches = [re.escape(char) + trie_pattern(child) for char, child in sorted(node.items())]
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')'
+
+class IgnoreFilter:
+    """
+    Compiled ignore settings for a domain.
+    Paths are prefixes of the page, matched with one anchored regex built from a trie.
+    Extensions are suffixes of the last path segment (query strings and
+    fragments are left out, so '.js' doesn't match '/foo.json' or '/x?f=a.js').
+    """
+    def __init__(self, paths_ignore=None, ext_ignore=None):
+        paths = split_setting(paths_ignore)
+        self.paths_match = re.compile(trie_pattern(prefix_trie(paths))).match if paths else None
+        self.extensions = frozenset('.' + ext.lstrip('.').lower() for ext in split_setting(ext_ignore))
+
+    def __bool__(self):
+        return bool(self.paths_match or self.extensions)
+
+    def ignore(self, page):
+        """
+        Should this page be left out of the report?
+        """
+        if self.paths_match is not None and self.paths_match(page):
+            return True
+        if self.extensions:
+            end = len(page)
+            for separator in '?#':
+                index = page.find(separator, 0, end)
+                if index != -1:
+                    end = index
+            name = page[page.rfind('/', 0, end) + 1:end].lower()
+            dot = name.find('.')
+            while dot != -1:
+                if name[dot:] in self.extensions:
+                    return True
+                dot = name.find('.', dot + 1)
+        return False
+
+@functools.lru_cache(maxsize=256)
+def get_ignore_filter(paths_ignore, ext_ignore):
+    """
+    IgnoreFilter for a domain's settings, compiled once per process
+    """
+    return IgnoreFilter(paths_ignore, ext_ignore)
@@ -0,0 +1,96 @@
+"""
+One-time move of log files into the partitioned S3 layout
+
+RawLogFile_, Azure_CDN_log_ and LogAnalysis files at the top of a domain's
+bucket move to raw/<domain>/<yyyy>/<mm>/<dd>/ and analysis/<domain>/<yyyy>/<mm>/<dd>/.
+Logs written by CDNs (cloudfront, fastly) stay where they are.
+"""
+import re
+import datetime
+import logging
+import click
+from botocore.exceptions import BotoCoreError, ClientError
+from system_utilities import get_configs
+from log_reporting_utilities import filter_and_get_date
+from s3_utilities import get_s3_client, list_unpartitioned, partition_key, RAW_ROOT, ANALYSIS_ROOT
+from db_utilities import get_domain_configs, rename_log_manifest_keys
+
+logger = logging.getLogger('logger')
+
+RUN_DATE_MATCH = re.compile(r'[0-9]{2}-[a-zA-Z]{3}-20[0-9]{2}:[0-9]{2}:[0-9]{2}:[0-9]{2}')
+
+def partitioned_key(key, domain, domain_data):
+    """
+    Where a top level file belongs in the partitioned layout
+    :returns new key, or False if it stays at the top (CDN logs, other domains)
+    """
+    if ((key.startswith('LogAnalysis') and f"_{domain}_" in key) or
+        key.startswith(f"RawLogFile_{domain}_")):
+        # named by log_stats or move_logs, with the date of the run
+        root = ANALYSIS_ROOT if key.startswith('LogAnalysis') else RAW_ROOT
+        date_match = RUN_DATE_MATCH.search(key)
+        file_date = datetime.datetime.strptime(date_match.group(0), '%d-%b-%Y:%H:%M:%S') if date_match else False
+    elif domain_data['azure_profile'] and key.startswith(f"Azure_CDN_log_{domain_data['azure_profile']}_"):
+        root = RAW_ROOT
+        file_date = filter_and_get_date(key)
+    else:
+        return False
+    if not file_date:
+        return False
+    return partition_key(root, domain, file_date, key)
+
+@click.command()
+@click.option('--domain', type=str, help="Domain to migrate. Default is 'all'", default='all')
+@click.option('--dry-run', is_flag=True, help="Only list what would move", default=False)
+def migrate(domain, dry_run):
+    """
+    Move log files into the partitioned S3 layout
+    """
+    client = get_s3_client()
+    for name, domain_data in get_domain_configs().items():
+        if ((domain != 'all') and (name != domain)) or not domain_data['s3_bucket']:
+            continue
+        bucket = domain_data['s3_bucket']
+        renames = {}
+        try:
+            for s3_object in list(list_unpartitioned(bucket, client=client)):
+                old_key = s3_object['Key']
+                new_key = partitioned_key(old_key, name, domain_data)
+                if not new_key:
+                    continue
+                logger.info(f"{bucket}: {old_key} -> {new_key}")
+                if dry_run:
+                    continue
+                client.copy_object(Bucket=bucket, Key=new_key,
+                                   CopySource={'Bucket': bucket, 'Key': old_key})
+                client.delete_object(Bucket=bucket, Key=old_key)
+                renames[old_key] = new_key
+        except (BotoCoreError, ClientError) as e:
+            logger.warning(f"Couldn't migrate bucket {bucket} for {name}: {e}")
+        finally:
+            # keep the manifest in step with whatever did move, so those
+            # files aren't analyzed (and rolled up) twice
+            rename_log_manifest_keys(domain_data['id'], renames)
+        logger.info(f"{name}: moved {len(renames)} files")
+
+    return
+
+if __name__ == '__main__':
+    configs = get_configs()
+    log = configs['log_level']
+    logger = logging.getLogger('logger')  # instantiate clogger
+    logger.setLevel(logging.DEBUG)  # pass DEBUG and higher values to handler
+
+    ch = logging.StreamHandler()  # use StreamHandler, which prints to stdout
+    ch.setLevel(configs['log_level'])  # ch handler uses the configura
+
+    # create formatter
+    # display the function name and logging level in columnar format if
+    # logging mode is 'DEBUG'
+    formatter = logging.Formatter('[%(funcName)24s] [%(levelname)8s] %(message)s')
+
+    # add formatter to ch
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    migrate()
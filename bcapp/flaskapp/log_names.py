@@ -0,0 +1,36 @@
+"""
+Log file names: compressed and rotated logs
+
+No dependencies beyond the standard library, so move_logs and log_shipper
+can tell logs apart without loading the reporting code.
+"""
+import re
+
+# Extensions of compressed log files, which read_log_lines decodes
+COMPRESSED_EXTENSIONS = ('gz', 'bz2', 'zst')
+# Compressed logs log_stats only reads with --unzip. zstd files are only
+# written by move_logs and log_shipper (--compress), so they are always read.
+ZIPPED_EXTENSIONS = ('gz', 'bz2')
+
+def is_compressed(file_name):
+    """
+    Whether a log file name has a compressed extension in it
+    (rotated files like access.log.2.gz, or logs compressed by move_logs)
+    """
+    return any(f".{ext}" in file_name for ext in COMPRESSED_EXTENSIONS)
+
+def is_zipped(file_name):
+    """
+    Whether a log file name has a gzip or bzip2 extension in it
+    """
+    return any(f".{ext}" in file_name for ext in ZIPPED_EXTENSIONS)
+
+# Names rotation gives old logs: access.log.1, access.log-20200101
+ROTATED = re.compile(r'[.-]\d+$')
+
+def is_rotated(file_name):
+    """
+    Whether a log file name is one rotation gives old logs (access.log.1,
+    access.log-20200101, or compressed), so it isn't written to any more
+    """
+    return bool(ROTATED.search(file_name)) or is_compressed(file_name)
@@ -0,0 +1,314 @@
+"""
+Log format parsers for log reporting
+
+One parser object per log format, with its regexes compiled once.
+Parsers are kept in a registry and picked by sniffing the start of a file.
+"""
+import re
+import json
+import calendar
+import datetime
+import functools
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger('logger')
+
+LOG_PARSERS = []
+
+# Minutes remembered per parser by parse_timestamp
+MINUTE_CACHE_SIZE = 10000
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def datetime_to_epoch(value):
+    """
+    Naive (UTC) datetime to epoch seconds
+    """
+    return calendar.timegm(value.timetuple())
+
+def epoch_to_datetime(epoch):
+    """
+    Epoch seconds to a naive (UTC) datetime
+    """
+    return EPOCH + datetime.timedelta(seconds=epoch)
+
+@functools.lru_cache(maxsize=1024)
+def status_number(status):
+    """
+    Status field of a parsed line (' 200 ', '200' or 200) as an int, 0 if it isn't one
+    """
+    try:
+        number = int(status)
+    except (TypeError, ValueError):
+        return 0
+    return number if 0 <= number < 1000 else 0
+
+def register_parser(parser_class):
+    """
+    Adds a parser to the registry, keeping it in sniffing order
+    (lowest priority value is tried first)
+    """
+    LOG_PARSERS.append(parser_class())
+    LOG_PARSERS.sort(key=lambda parser: parser.priority)
+    return parser_class
+
+def get_parser(log_type):
+    """
+    Get the registered parser for a log type
+    """
+    for parser in LOG_PARSERS:
+        if parser.log_type == log_type:
+            return parser
+    return False
+
+def sniff_parser(sample):
+    """
+    Pick the parser for a file from the first line(s) of its text
+    :arg sample: decoded text from the start of the file
+    :returns: parser object, or False if nothing matches
+    """
+    if not sample:
+        return False
+    first_line = sample.split('\n', 1)[0]
+    for parser in LOG_PARSERS:
+        if parser.sniff(first_line):
+            return parser
+    return False
+
+class LogParser:
+    """
+    Base log parser. Subclasses set log_type and implement sniff and parse.
+
+    Subclasses with a fixed-width timestamp also set timestamp_length,
+    minute_end (where the minutes end and ':SS' starts) and minute_format,
+    for parse_timestamp.
+    """
+    log_type = None
+    priority = 50
+    time_format = None
+    timestamp_length = None
+    minute_end = None
+    minute_format = None
+
+    def __init__(self):
+        self.minute_cache = {}
+
+    def sniff(self, first_line):
+        """
+        Cheap test of whether a file starting with first_line is in this format
+        """
+        raise NotImplementedError
+
+    def parse(self, line):
+        """
+        Parse one log line into a dict with (some of) datetime, status,
+        ip, user_agent, page_visited. Returns None if the line is unusable.
+        """
+        raise NotImplementedError
+
+    def sniff_host(self, line):
+        """
+        Host name a log line was served for, if the format records one
+        """
+        return None
+
+    def parse_datetime(self, value):
+        """
+        Turn the datetime field of a parsed line into a datetime, or False
+        """
+        try:
+            return datetime.datetime.strptime(value, self.time_format)
+        except (TypeError, ValueError):
+            return False
+
+    def parse_timestamp(self, value):
+        """
+        Turn the datetime field of a parsed line into epoch seconds, or False.
+        Same result as parse_datetime, but the seconds are sliced off and the
+        rest is memoized, so strptime runs about once per minute of log
+        rather than once per line.
+        """
+        if self.minute_end is None or not isinstance(value, str) or len(value) != self.timestamp_length:
+            log_date = self.parse_datetime(value)
+            return datetime_to_epoch(log_date) if log_date else False
+        minute_end = self.minute_end
+        prefix = value[:minute_end]
+        minute = self.minute_cache.get(prefix)
+        if minute is None:
+            try:
+                minute = datetime_to_epoch(datetime.datetime.strptime(prefix, self.minute_format))
+            except ValueError:
+                minute = False
+            if len(self.minute_cache) >= MINUTE_CACHE_SIZE:
+                self.minute_cache.clear()
+            self.minute_cache[prefix] = minute
+        if minute is False or value[minute_end] != ':':
+            return False
+        seconds = value[minute_end + 1:minute_end + 3]
+        if not (seconds.isascii() and seconds.isdigit()) or seconds > '59':
+            return False
+        return minute + int(seconds)
+
+@register_parser
+class AzureParser(LogParser):
+    """
+    Azure CDN access logs: one JSON document per line
+    """
+    log_type = 'azure'
+    priority = 10
+    time_format = '%Y-%m-%dT%H:%M:%S.%f'
+    # 2020-05-12T00:00:00.0000000Z
+    timestamp_length = 28
+    minute_end = 16
+    minute_format = '%Y-%m-%dT%H:%M'
+
+    def sniff(self, first_line):
+        return first_line[:1] == '{'
+
+    def parse(self, line):
+        try:
+            line_json = json.loads(line)
+        except ValueError:
+            logger.debug("Can't parse - isn't json!")
+            return None
+        try:
+            properties = line_json['properties']
+            return {
+                'status': properties['httpStatusCode'],
+                'datetime': line_json['time'],
+                'user_agent': properties['userAgent'],
+                'page_visited': properties['requestUri'],
+                'ip': properties['clientIp']
+            }
+        except (KeyError, TypeError):
+            return None
+
+    def sniff_host(self, line):
+        log_data = self.parse(line)
+        if not log_data:
+            return None
+        try:
+            return urlsplit(log_data['page_visited']).hostname
+        except (AttributeError, ValueError):
+            return None
+
+    def parse_datetime(self, value):
+        try:
+            return datetime.datetime.strptime(value[:-2], self.time_format)
+        except (TypeError, ValueError):
+            return False
+
+    def parse_timestamp(self, value):
+        if isinstance(value, str) and len(value) == self.timestamp_length:
+            # the fraction is checked here, then dropped
+            if value[19] != '.' or not value[20:26].isdigit():
+                return False
+        return super().parse_timestamp(value)
+
+@register_parser
+class CloudfrontParser(LogParser):
+    """
+    Cloudfront access logs: tab separated, with '#' comment headers
+    """
+    log_type = 'cloudfront'
+    priority = 20
+    time_format = '%Y-%m-%d\t%H:%M:%S'
+    timestamp_length = 19
+    minute_end = 16
+    minute_format = '%Y-%m-%d\t%H:%M'
+
+    def sniff(self, first_line):
+        return 'Version' in first_line
+
+    def parse(self, line):
+        line_items = line.split('\t')
+        try:
+            return {
+                'datetime': line_items[0] + '\t' + line_items[1],
+                'status': line_items[8],
+                'user_agent': line_items[10],
+                'page_visited': line_items[7],
+                'ip': line_items[4]
+            }
+        except IndexError:
+            return None
+
+    def sniff_host(self, line):
+        # x-host-header
+        line_items = line.split('\t')
+        if len(line_items) > 15 and line_items[15] != '-':
+            return line_items[15]
+        return None
+
+@register_parser
+class FastlyParser(LogParser):
+    """
+    Fastly logs, in the format: %v %h %t %m "%r" %>s
+    Each line starts with '<###>'
+    """
+    log_type = 'fastly'
+    priority = 30
+    time_format = '[%d/%b/%Y:%H:%M:%S'
+    timestamp_length = 21
+    minute_end = 18
+    minute_format = '[%d/%b/%Y:%H:%M'
+    sniff_match = re.compile(r'\<\d{3}\>')
+
+    def sniff(self, first_line):
+        return bool(self.sniff_match.search(first_line))
+
+    def parse(self, line):
+        line_items = line.split(' ')
+        try:
+            log_data = {
+                'status': line_items[11],
+                'datetime': line_items[5],
+                'user_agent': 'No User Agent Recorded',
+                'page_visited': line_items[9],
+                'ip': line_items[4]
+            }
+        except IndexError:
+            return None
+        if ((len(log_data['status']) != 3) or ('.' not in log_data['ip']) or (log_data['datetime'][:1] != '[')):
+            # log format is off
+            return None
+        return log_data
+
+    def sniff_host(self, line):
+        # %v
+        line_items = line.split(' ')
+        return line_items[3] if len(line_items) > 3 else None
+
+@register_parser
+class NginxParser(LogParser):
+    """
+    Nginx (and EOTK) combined logs. Sniffs everything, so it's tried last.
+    """
+    log_type = 'nginx'
+    priority = 100
+    time_format = '%d/%b/%Y:%H:%M:%S'
+    timestamp_length = 20
+    minute_end = 17
+    minute_format = '%d/%b/%Y:%H:%M'
+    date_match = re.compile(r'[0-9]{2}[\/]{1}[A-Za-z]{3}[\/]{1}[0-9]{4}[:]{1}[0-9]{2}[:]{1}[0-9]{2}[:]{1}[0-9]{2}')
+    status_match = re.compile(r'[\ ]{1}[0-9]{3}[\ ]{1}')
+    ip_match = re.compile(r'[0-9]{1,3}[\.]{1}[0-9]{1,3}[\.]{1}[0-9]{1,3}[\.]{1}[0-9]{1,3}')
+
+    def sniff(self, first_line):
+        return True
+
+    def parse(self, line):
+        log_data = {}
+        try:
+            log_data['datetime'] = self.date_match.search(line).group(0)
+            log_data['status'] = self.status_match.search(line).group(0)
+            log_data['ip'] = self.ip_match.search(line).group(0)
+        except AttributeError:
+            pass
+        quoted = line.split(' "')
+        log_data['user_agent'] = quoted[-1]
+        try:
+            log_data['page_visited'] = quoted[-3].split(' ')[1]
+        except IndexError:
+            pass
+        return log_data
@@ -4,225 +4,739 @@ Used by command line and flask app
 """
 import re
 import os
+import math
+import io
+import gzip
+import bz2
+import mmap
 import datetime
 import logging
 import json
+import zlib
+import itertools
+from contextlib import ExitStack
+import zstandard
 from dotenv import load_dotenv
 from simple_AWS.s3_functions import *
 import sqlalchemy as db
 from system_utilities import get_configs
-from db_utilities import get_domain_data, report_save
+from db_utilities import get_domain_data, report_save, get_log_rollups
+from log_parsers import sniff_parser, get_parser, status_number, datetime_to_epoch, epoch_to_datetime
+from log_sketches import HeavyHitters, HyperLogLog
+from log_series import HourlySeries
+from log_columns import ColumnBuffer
+from log_spill import SpilledCounts
+from log_filters import get_ignore_filter
+from log_names import COMPRESSED_EXTENSIONS
+from s3_utilities import open_s3_object, read_s3_head, list_s3_objects, list_unpartitioned, RAW_ROOT, ANALYSIS_ROOT
 
 logger = logging.getLogger('logger')
 
-def analyze_file(raw_data, domain):
+def read_log_lines(file_name, fileobj=None):
     """
-    Analyzes the raw data from the file - for status, agents and pages
-    :arg: raw_data
-    :returns: dict of dicts
+    Yields the lines of a log file one at a time, decompressing
+    gzip, bz2 and zstd files in-process as it goes. Uncompressed local
+    files are memory-mapped.
+    :arg file_name: name of the file, extension picks the decoder
+    :arg fileobj: optional binary file object to read instead of opening file_name
     """
-    domain_data = get_domain_data(domain)
+    ext = file_name.split('.')[-1]
+    if fileobj is None and ext not in COMPRESSED_EXTENSIONS:
+        yield from read_mapped_lines(file_name)
+        return
+    with ExitStack() as stack:
+        if fileobj is None:
+            fileobj = stack.enter_context(open(file_name, 'rb'))
+        if ext == 'gz':
+            fileobj = stack.enter_context(gzip.GzipFile(fileobj=fileobj))
+        elif ext == 'bz2':
+            fileobj = stack.enter_context(bz2.BZ2File(fileobj))
+        elif ext == 'zst':
+            fileobj = stack.enter_context(zstandard.ZstdDecompressor().stream_reader(fileobj))
+        # split on '\n' only and strip '\r\n', like read_mapped_lines
+        text = io.TextIOWrapper(fileobj, encoding='utf-8', errors='replace', newline='\n')
+        for line in text:
+            yield line.rstrip('\r\n')
+
+def read_mapped_lines(file_name):
+    """
+    Yields the lines of an uncompressed local file, memory-mapped
+    rather than read through buffers
+    """
+    with open(file_name, 'rb') as log_file:
+        if not os.fstat(log_file.fileno()).st_size:
+            return
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for line in iter(mapped.readline, b''):
+                yield line.decode('utf-8', 'replace').rstrip('\r\n')
+
+# Bytes read from the start of a file to sniff it, and the most text decoded from them
+SNIFF_BYTES = 16 * 1024
+SNIFF_TEXT = 64 * 1024
+# How files written by log_stats start: LogAnalysis JSON (now, and the
+# old str(dict) dumps), and LogAnalysisOutput reports
+ANALYSIS_STARTS = ('{"aggregate":', "{'", 'Analysis of: ')
+
+def decode_head(file_name, data, max_text=SNIFF_TEXT):
+    """
+    Decode the first bytes of a log file, decompressing only what's there
+    :arg file_name: name of the file, extension picks the decoder
+    :arg data: bytes from the start of the file
+    :returns: text, ending in a partial line - '' if there isn't enough to decode
+        (bz2 needs a whole block, up to 900KB)
+    """
+    ext = file_name.split('.')[-1]
+    try:
+        if ext == 'gz':
+            data = zlib.decompressobj(wbits=31).decompress(data, max_text)
+        elif ext == 'bz2':
+            data = bz2.BZ2Decompressor().decompress(data, max_text)
+        elif ext == 'zst':
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(data)[:max_text]
+        else:
+            data = data[:max_text]
+    except (zlib.error, zstandard.ZstdError, OSError, EOFError):
+        return ''
+    return data.decode('utf-8', 'replace')
+
+def rejected_name(key, domain, domain_data):
+    """
+    Why a file isn't one of the domain's logs, going by its name ('' if it may be).
+    RawLogFile_ and Azure_CDN_log_ files are named for their domain and Azure profile.
+    """
+    name = key.rsplit('/', 1)[-1]
+    if 'LogAnalysis' in name:
+        return "analysis file"
+    if name.startswith('RawLogFile_') and not name.startswith(f"RawLogFile_{domain}_"):
+        return "another domain's file"
+    if name.startswith('Azure_CDN_log_') and not (domain_data['azure_profile'] and
+                                                  name.startswith(f"Azure_CDN_log_{domain_data['azure_profile']}_")):
+        return "another Azure profile's file"
+    return ''
+
+def sniff_log_file(key, head, domain, domain_data):
+    """
+    Decide from a file's name and first bytes whether it's one of the
+    domain's logs, and in which format
+    :arg head: bytes from the start of the file, see SNIFF_BYTES
+    :returns: (parser, reason) - the parser if it's one of the domain's logs,
+        False and why not if it isn't, None if the head doesn't tell
+    """
+    reason = rejected_name(key, domain, domain_data)
+    if reason:
+        return False, reason
+    if not head:
+        return False, "empty file"
+    text = decode_head(key, head)
+    if not text:
+        return None, "can't decode the start"
+    if text.startswith(ANALYSIS_STARTS):
+        return False, "analysis file"
+    parser = sniff_parser(text)
+    if not parser:
+        return False, "unknown log format"
+    # the host of the first line, if the format has it (CDNs shared between domains)
+    for line in text.split('\n')[:-1]:
+        if not line or line[0] == '#':
+            continue
+        host = parser.sniff_host(line)
+        if host and domain not in host:
+            owner = get_domain_data(host)
+            if owner and owner['id'] != domain_data['id']:
+                return False, f"logs for {host}"
+        break
+    return parser, ''
+
+def open_log_object(bucket, key, domain, domain_data=None, max_buffer=0, client=None):
+    """
+    Open an S3 log file if it's one of the domain's logs, deciding from
+    its first bytes (a ranged GET) before downloading the rest
+    :arg domain_data: optional domain settings, looked up if not given
+    :arg max_buffer: see open_s3_object
+    :returns: binary file object, or None if the file isn't one of the domain's logs
+    """
+    if domain_data is None:
+        domain_data = get_domain_data(domain)
+    reason = rejected_name(key, domain, domain_data)
+    if reason:
+        logger.debug(f"Skipping {key}: {reason}")
+        return None
+    head, size = read_s3_head(bucket, key, SNIFF_BYTES, client=client)
+    parser, reason = sniff_log_file(key, head, domain, domain_data)
+    if parser is False:
+        logger.debug(f"Skipping {key}: {reason}")
+        return None
+    if len(head) >= size:
+        # that was all of it
+        return io.BytesIO(head)
+    return open_s3_object(bucket, key, max_buffer=max_buffer, client=client)
+
+def analyze_file(log_lines, domain, domain_data=None, hourly=False, capacity=0, engine='dict'):
+    """
+    Analyzes the lines from the file - for status, agents and pages
+    :arg: log_lines - iterable of lines, see read_log_lines
+    :arg: domain_data - optional domain settings, looked up if not given
+    :arg: hourly - also break the counts down by hour, for the rollups table
+    :arg: capacity - count pages and agents approximately, see LogAggregate
+    :arg: engine - 'dict' counts line by line, 'columnar' buffers columns
+        and counts them with numpy (see log_columns). Same results.
+    :returns: LogAggregate for the file, log type
+    """
+    if domain_data is None:
+        domain_data = get_domain_data(domain)
     if not domain_data:
-        return False
+        return False, False
 
-    if domain_data['paths_ignore']:
-        paths_ignore_list = domain_data['paths_ignore'].split(',')
-    else:
-        paths_ignore_list = False
-    if domain_data['ext_ignore']:
-        exts_ignore_list = domain_data['ext_ignore'].split(',')
-    else:
-        exts_ignore_list = False
-    
-    #logger.debug(f"Paths: {paths_ignore_list} Ext: {exts_ignore_list}")
+    ignore_filter = get_ignore_filter(domain_data['paths_ignore'], domain_data['ext_ignore'])
+    ignore = ignore_filter.ignore if ignore_filter else None
 
-    raw_data_list = raw_data.split('\n')
-    #logger.debug(f"raw length: {len(raw_data_list)} first chars: {raw_data_list[0][0]}")
-    fastly_log_match = re.compile('\<\d{3}\>')
-    try:
-        fastly_match = fastly_log_match.search(raw_data_list[0]).group(0)
-    except:
-        fastly_match = False
+    log_lines = iter(log_lines)
+    first_line = next(log_lines, '')
     #What kind of log formats are these?
-    if raw_data_list[0][0] == '{': # it's json
-        log_type = 'azure'
-    elif 'Version' in raw_data_list[0]: #cloudfront
-        log_type = 'cloudfront'
-        raw_data_list = raw_data_list[2:] #getting rid of first two lines, which are comments
-    elif fastly_match: # Fastly logs have '<###>' at the beginning of each line
-        log_type = 'fastly'
-    else:
-        log_type = 'nginx'
+    parser = sniff_parser(first_line)
+    if not parser:
+        return False, False
+    log_type = parser.log_type
+    parse = parser.parse
+    parse_timestamp = parser.parse_timestamp
 
     logger.debug(F"Log type: {log_type}")
-    final_log_data = []
-    for line in raw_data_list:
+    aggregate = LogAggregate(log_type, hourly=hourly, capacity=capacity)
+    if engine == 'columnar':
+        columns = ColumnBuffer(aggregate)
+        add = columns.add
+    else:
+        add = aggregate.add
+    for line in itertools.chain([first_line], log_lines):
         if not line:
             continue
         if line[0] == '#':
             continue
-        log_data = {}
-        if log_type == 'nginx':
-            log_date_match = re.compile('[0-9]{2}[\/]{1}[A-Za-z]{3}[\/]{1}[0-9]{4}[:]{1}[0-9]{2}[:]{1}[0-9]{2}[:]{1}[0-9]{2}')
-            log_status_match = re.compile('[\ ]{1}[0-9]{3}[\ ]{1}')
-            log_ip_match = re.compile('[0-9]{1,3}[\.]{1}[0-9]{1,3}[\.]{1}[0-9]{1,3}[\.]{1}[0-9]{1,3}')
-            try:
-                log_data['datetime'] = log_date_match.search(line).group(0)
-                log_data['status'] = log_status_match.search(line).group(0)
-                log_data['ip'] = log_ip_match.search(line).group(0)
-            except:
-                pass
-            try:
-                log_data['user_agent'] = line.split(' "')[-1]
-            except:
-                pass
-            try:
-                log_data['page_visited'] = line.split(' "')[-3].split(' ')[1]
-            except:
-                pass
-        elif log_type == 'cloudfront':
-            line_items = line.split('\t')
-            try:
-                ymd = line_items[0]
-                hms = line_items[1]
-                date_time = ymd + '\t' + hms
-                log_data['datetime'] = date_time
-                log_data['status'] = line_items[8]
-                log_data['user_agent'] = line_items[10]
-                log_data['page_visited'] = line_items[7]
-            except:
-                continue
-        elif log_type == 'fastly':
-            line_items = line.split(' ')
-            # We will parse assuming format: %v %h %t %m "%r" %>s
-            try:
-                log_data['status'] = line_items[11]
-                log_data['datetime'] = line_items[5]
-                log_data['user_agent'] = 'No User Agent Recorded'
-                log_data['page_visited'] = line_items[9]
-                log_data['ip'] = line_items[4]
-                log_domain = line_items[3]
-            except:
-                continue
-            if ((len(log_data['status']) != 3) or ('.' not in log_data['ip']) or (log_data['datetime'][0] != '[')):
-                # log format is off
-                continue
-            
-        elif log_type == 'azure':
-            try:
-                line_json = json.loads(line)
-            except:
-                logger.debug("Can't parse - isn't json!")
-                continue
-
-            log_data['status'] = line_json['properties']['httpStatusCode']
-            log_data['datetime'] = line_json['time']
-            log_data['user_agent'] = line_json['properties']['userAgent']
-            log_data['page_visited'] = line_json['properties']['requestUri']
-            log_data['ip'] = line_json['properties']['clientIp']
-
-        else:
+        log_data = parse(line)
+        if not log_data:
             continue
 
         if 'page_visited' not in log_data:
             continue
             
-        if exts_ignore_list:
-            ext_ignore = False
-            for ext in exts_ignore_list:
-                if ext in log_data['page_visited']:
-                    ext_ignore = True
-            if ext_ignore:
-                #logger.debug(f"page: {log_data['page_visited']} Ignore: {ext_ignore} ")
-                continue
-        if paths_ignore_list:
-            should_skip = False
-            for ignore in paths_ignore_list:
-                ig_len = len(ignore)
-                if ignore == log_data['page_visited'][:ig_len]:
-                    should_skip = True
-            if should_skip:
-                #logger.debug(f"page: {log_data['page_visited'][:ig_len]} - Skip: {should_skip}")
+        if ignore is not None and ignore(log_data['page_visited']):
+            continue
+
+        if 'datetime' in log_data:
+            log_time = parse_timestamp(log_data['datetime'])
+        else:
+            log_time = False
+        add(log_data, log_time)
+
+    if engine == 'columnar':
+        columns.flush()
+    return aggregate, log_type
+
+# Pages and user agents kept per hour in the rollups table
+ROLLUP_TOP = 100
+
+# Version of what LogAggregate.to_state saves, kept with each manifest entry.
+# Entries saved with an older version are analyzed again.
+# 2: visitors (HyperLogLog) sketch
+STATE_VERSION = 2
+
+HOME_PAGE_MATCH = re.compile(r"\:[0-9]{2,3}\/$")
+
+class LogAggregate:
+    """
+    Counts for one log type, reduced line by line and merged across files,
+    so memory grows with the number of distinct values rather than hits
+    """
+    counters = ('visitor_ips', 'status', 'user_agent', 'pages_visited', 'home_pages')
+
+    def __init__(self, log_type, hourly=False, track_ips=True, capacity=0, spill=None):
+        """
+        :arg log_type
+        :arg hourly: also keep an aggregate per hour, for the rollups table
+        :arg track_ips: count visitor IPs
+        :arg capacity: if set, count IPs, pages and user agents with fixed-size
+            HeavyHitters summaries of this many items instead of exactly
+            (the hourly aggregates too)
+        :arg spill: optional SpillBudget - count IPs, pages and user agents
+            exactly, spilling them to disk past the budget (see log_spill).
+            Not with capacity.
+        """
+        self.log_type = log_type
+        self.track_ips = track_ips
+        self.capacity = capacity
+        self.spill = spill if not capacity else None
+        self.hits = 0
+        self.status = {}
+        if capacity:
+            self.visitor_ips = HeavyHitters(capacity)
+            self.user_agent = HeavyHitters(capacity)
+            self.pages_visited = HeavyHitters(capacity)
+        elif spill is not None:
+            self.visitor_ips = SpilledCounts(spill)
+            self.user_agent = SpilledCounts(spill)
+            self.pages_visited = SpilledCounts(spill)
+        else:
+            self.visitor_ips = {}
+            self.user_agent = {}
+            self.pages_visited = {}
+        # distinct visitor IPs, mergeable across files and days
+        self.visitors = HyperLogLog() if track_ips else None
+        # per hour hits, errors and home page hits for the report
+        self.series = HourlySeries() if track_ips else None
+        self.home_pages = {}
+        # epoch seconds, see log_parsers.parse_timestamp
+        self.earliest = None
+        self.latest = None
+        self.hourly = {} if hourly else None
+
+    def add(self, log_data, log_time):
+        """
+        Count a parsed line
+        :arg log_data: dict from the log parser
+        :arg log_time: epoch seconds of the line, or False if it couldn't be parsed
+        """
+        self.hits += 1
+        if log_time is False or 'status' not in log_data:
+            return
+        if self.earliest is None or log_time < self.earliest:
+            self.earliest = log_time
+        if self.latest is None or log_time > self.latest:
+            self.latest = log_time
+
+        # HeavyHitters and SpilledCounts count with add
+        counted = self.capacity or self.spill is not None
+        if self.track_ips and 'ip' in log_data:
+            ip = log_data['ip']
+            if counted:
+                self.visitor_ips.add(ip)
+                self.visitors.add(ip)
+            else:
+                seen = self.visitor_ips.get(ip)
+                if seen is None:
+                    # exact counts: only new IPs need to go into the sketch
+                    self.visitors.add(ip)
+                    self.visitor_ips[ip] = 1
+                else:
+                    self.visitor_ips[ip] = seen + 1
+        self.status[log_data['status']] = self.status.get(log_data['status'], 0) + 1
+        page = log_data['page_visited']
+        if counted:
+            self.user_agent.add(log_data['user_agent'])
+            self.pages_visited.add(page)
+        else:
+            self.user_agent[log_data['user_agent']] = self.user_agent.get(log_data['user_agent'], 0) + 1
+            self.pages_visited[page] = self.pages_visited.get(page, 0) + 1
+        home = self.is_home_page(page)
+        if home: #home page
+            self.home_pages[page] = self.home_pages.get(page, 0) + 1
+        if self.series is not None:
+            self.series.add(log_time, status_number(log_data['status']), home)
+
+        if self.hourly is not None:
+            hour = log_time - log_time % 3600
+            if hour not in self.hourly:
+                self.hourly[hour] = LogAggregate(self.log_type, track_ips=False, capacity=self.capacity)
+            self.hourly[hour].add(log_data, log_time)
+
+    @staticmethod
+    def is_home_page(page):
+        return (page == '/') or bool(HOME_PAGE_MATCH.search(page))
+
+    def merge(self, other):
+        """
+        Add another aggregate of the same log type into this one
+        """
+        self.hits += other.hits
+        for counter in self.counters:
+            counts = getattr(self, counter)
+            if isinstance(counts, (HeavyHitters, SpilledCounts)):
+                counts.merge(getattr(other, counter))
                 continue
-        
-        final_log_data.append(log_data)
-        
-    return final_log_data, log_type
+            for key, number in getattr(other, counter).items():
+                counts[key] = counts.get(key, 0) + number
+        if other.earliest is not None and (self.earliest is None or other.earliest < self.earliest):
+            self.earliest = other.earliest
+        if other.latest is not None and (self.latest is None or other.latest > self.latest):
+            self.latest = other.latest
+        if self.visitors is not None and other.visitors is not None:
+            self.visitors.merge(other.visitors)
+        if self.series is not None and other.series is not None:
+            self.series.merge(other.series)
+        if self.hourly is not None and other.hourly:
+            for hour, hour_aggregate in other.hourly.items():
+                if hour not in self.hourly:
+                    self.hourly[hour] = LogAggregate(self.log_type, track_ips=False, capacity=self.capacity)
+                self.hourly[hour].merge(hour_aggregate)
+        return self
+
+    def subtract(self, other):
+        """
+        Take the counts of another aggregate back out of this one.
+        Earliest and latest dates are left as they are.
+        Only for exact counts (capacity not set).
+        """
+        self.hits = max(self.hits - other.hits, 0)
+        for counter in self.counters:
+            counts = getattr(self, counter)
+            for key, number in getattr(other, counter).items():
+                remaining = counts.get(key, 0) - number
+                if remaining > 0:
+                    counts[key] = remaining
+                else:
+                    counts.pop(key, None)
+        return self
+
+    def truncated(self, num):
+        """
+        Copy of this aggregate (without the hourly breakdown) keeping
+        only the top num pages and user agents
+        """
+        aggregate = LogAggregate(self.log_type, track_ips=self.track_ips)
+        aggregate.merge(self)
+        for counter in ('pages_visited', 'user_agent'):
+            counts = getattr(aggregate, counter)
+            if len(counts) > num:
+                top = sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:num]
+                setattr(aggregate, counter, dict(top))
+        return aggregate
+
+    def to_state(self):
+        """
+        JSON-serializable state, for storing partial aggregates
+        """
+        state = {
+            'log_type': self.log_type,
+            'hits': self.hits,
+            'earliest': epoch_to_datetime(self.earliest).isoformat() if self.earliest is not None else None,
+            'latest': epoch_to_datetime(self.latest).isoformat() if self.latest is not None else None
+        }
+        for counter in self.counters:
+            counts = getattr(self, counter)
+            if isinstance(counts, HeavyHitters):
+                state[counter] = {'heavy_hitters': counts.to_state()}
+            else:
+                state[counter] = list(counts.items())
+        if self.visitors is not None:
+            state['visitors'] = self.visitors.to_state()
+        if self.series is not None:
+            state['series'] = self.series.to_state()
+        if self.hourly is not None:
+            state['hourly'] = hourly_to_state(self.hourly)
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Rebuild an aggregate saved with to_state
+        """
+        aggregate = cls(state['log_type'])
+        aggregate.hits = state['hits']
+        if state['earliest']:
+            aggregate.earliest = datetime_to_epoch(datetime.datetime.fromisoformat(state['earliest']))
+            aggregate.latest = datetime_to_epoch(datetime.datetime.fromisoformat(state['latest']))
+        for counter in cls.counters:
+            if isinstance(state[counter], dict):
+                heavy_hitters = HeavyHitters.from_state(state[counter]['heavy_hitters'])
+                if counter == 'pages_visited':
+                    aggregate.capacity = heavy_hitters.capacity
+                setattr(aggregate, counter, heavy_hitters)
+            else:
+                setattr(aggregate, counter, {key: number for key, number in state[counter]})
+        if state.get('visitors'):
+            aggregate.visitors = HyperLogLog.from_state(state['visitors'])
+        if state.get('series'):
+            aggregate.series = HourlySeries.from_state(state['series'])
+        if state.get('hourly') is not None:
+            aggregate.hourly = hourly_from_state(state['hourly'])
+        return aggregate
+
+    def home_page_hits(self):
+        """
+        Hits on the home page. Azure logs carry full URLs, so there
+        each distinct home page URL counts once.
+        """
+        if self.log_type == 'azure':
+            return len(self.home_pages)
+        return sum(self.home_pages.values())
+
+    def to_dict(self, top=0):
+        """
+        The analyzed data, in the form output() expects
+        :arg top: for counts spilled to disk, how many of each to merge back
+            into memory (the largest), see report_top. 0 is all of them.
+        """
+        analyzed_log_data = {
+            'status': self.status,
+            'hits': self.hits
+        }
+        counters = ('visitor_ips', 'user_agent', 'pages_visited') if self.track_ips else ('user_agent', 'pages_visited')
+        for counter in counters:
+            counts = getattr(self, counter)
+            if isinstance(counts, HeavyHitters):
+                analyzed_log_data[counter] = dict(counts.items())
+                analyzed_log_data[counter + '_error'] = counts.error
+            elif isinstance(counts, SpilledCounts):
+                analyzed_log_data[counter], analyzed_log_data[counter + '_count'] = counts.summary(top)
+            else:
+                analyzed_log_data[counter] = counts
+        if self.visitors is not None:
+            if isinstance(self.visitor_ips, HeavyHitters):
+                analyzed_log_data['unique_visitors'] = self.visitors.estimate()
+                analyzed_log_data['unique_visitors_estimated'] = True
+            elif isinstance(self.visitor_ips, SpilledCounts):
+                analyzed_log_data['unique_visitors'] = analyzed_log_data['visitor_ips_count']
+            else:
+                analyzed_log_data['unique_visitors'] = len(self.visitor_ips)
+            analyzed_log_data['visitor_sketch'] = self.visitors.to_state()
+        if self.home_pages:
+            analyzed_log_data['home_page_hits'] = self.home_page_hits()
+        series = self.series.to_state() if self.series is not None else None
+        if series:
+            analyzed_log_data['hourly_series'] = series
+        if self.earliest is not None:
+            analyzed_log_data['earliest_date'] = epoch_to_datetime(self.earliest).strftime('%d/%b/%Y:%H:%M:%S')
+            analyzed_log_data['latest_date'] = epoch_to_datetime(self.latest).strftime('%d/%b/%Y:%H:%M:%S')
+        return analyzed_log_data
+
+def hourly_to_state(hourly):
+    """
+    JSON-serializable state of an aggregate's hourly breakdown, each hour
+    cut to the top ROLLUP_TOP pages and user agents
+    """
+    return [[epoch_to_datetime(hour).isoformat(), hour_aggregate.truncated(ROLLUP_TOP).to_state()]
+            for hour, hour_aggregate in hourly.items()]
 
-def analyze_data(compiled_log_data, log_type):
+def hourly_from_state(state):
+    """
+    Rebuild an hourly breakdown saved with hourly_to_state
+    :returns dict of epoch hour to LogAggregate
+    """
+    hourly = {}
+    for hour, hour_state in state:
+        hour_aggregate = LogAggregate.from_state(hour_state)
+        hour_aggregate.track_ips = False
+        hour_aggregate.visitors = None
+        hour_aggregate.series = None
+        hourly[datetime_to_epoch(datetime.datetime.fromisoformat(hour))] = hour_aggregate
+    return hourly
+
+def analyze_data(compiled_log_data, log_type, engine='dict'):
     """
     Analyze compiled data from different logs
+    :arg engine: 'dict' or 'columnar', see analyze_file
     """
     # logger.debug(f"Compiled data: {compiled_log_data}")
-
-    analyzed_log_data = {
-            'visitor_ips': {},
-            'status': {},
-            'user_agent': {},
-            'pages_visited' : {}
-        }
-    analyzed_log_data['hits'] = len(compiled_log_data)
-
-    datetimes = []
+    parse_timestamp = get_parser(log_type).parse_timestamp
+    aggregate = LogAggregate(log_type)
+    if engine == 'columnar':
+        columns = ColumnBuffer(aggregate)
+        add = columns.add
+    else:
+        add = aggregate.add
     for log_data in compiled_log_data:
-        if log_type == 'nginx':
-            try:
-                log_date = datetime.datetime.strptime(log_data['datetime'], '%d/%b/%Y:%H:%M:%S')
-            except:
-                log_date = False
-        elif log_type == 'fastly':
-            try:
-                log_date = datetime.datetime.strptime(log_data['datetime'], '[%d/%b/%Y:%H:%M:%S')
-            except:
-                log_date = False
-        elif log_type == 'cloudfront':
-            try:
-                log_date = datetime.datetime.strptime(log_data['datetime'], '%Y-%m-%d\t%H:%M:%S')
-            except:
-                log_date = False
-        elif log_type == 'azure':
-            try:
-                log_date = datetime.datetime.strptime(log_data['datetime'][:-2], '%Y-%m-%dT%H:%M:%S.%f')
-            except:
-                log_date = False
-
-        if log_date:
-            datetimes.append(log_date)
+        if 'datetime' in log_data:
+            log_time = parse_timestamp(log_data['datetime'])
         else:
-            continue
-        
-        if 'ip' in log_data:
-            if log_data['ip'] in analyzed_log_data['visitor_ips']:
-                analyzed_log_data['visitor_ips'][log_data['ip']] += 1
-            else:
-                analyzed_log_data['visitor_ips'][log_data['ip']] = 1
-        if log_data['status'] in analyzed_log_data['status']:
-            analyzed_log_data['status'][log_data['status']] += 1
+            log_time = False
+        add(log_data, log_time)
+    if engine == 'columnar':
+        columns.flush()
+
+    return aggregate.to_dict()
+
+# Saved LogAnalysis files: gzipped canonical JSON, see dump_analysis
+ANALYSIS_FORMAT = 'log-analysis'
+ANALYSIS_VERSION = 1
+
+def counts_to_columns(pairs):
+    """
+    [[key, count], ...] to {'keys': [...], 'counts': [...]}, sorted by key
+    """
+    pairs = sorted(pairs, key=lambda pair: (str(pair[0]), pair[1]))
+    return {
+        'keys': [key for key, count in pairs],
+        'counts': [count for key, count in pairs]
+    }
+
+def columns_to_counts(columns):
+    """
+    Back from counts_to_columns
+    """
+    return [list(pair) for pair in zip(columns['keys'], columns['counts'])]
+
+def state_columns(state, convert):
+    """
+    Apply convert to each counter of an aggregate state (and its hours)
+    """
+    state = dict(state)
+    for counter in LogAggregate.counters:
+        if isinstance(state[counter], dict) and 'heavy_hitters' in state[counter]:
+            heavy_hitters = dict(state[counter]['heavy_hitters'])
+            heavy_hitters['counts'] = convert(heavy_hitters['counts'])
+            state[counter] = {'heavy_hitters': heavy_hitters}
         else:
-            analyzed_log_data['status'][log_data['status']] = 1
-        if log_data['user_agent'] in analyzed_log_data['user_agent']:
-            analyzed_log_data['user_agent'][log_data['user_agent']] += 1
+            state[counter] = convert(state[counter])
+    if state.get('hourly') is not None:
+        state['hourly'] = sorted([hour, state_columns(hour_state, convert)]
+                                 for hour, hour_state in state['hourly'])
+    return state
+
+def dump_analysis(aggregate, domain, created):
+    """
+    Serialize an aggregate for a LogAnalysis file: versioned, gzipped JSON,
+    with each counter stored as sorted key and count columns.
+    The same aggregate always gives the same bytes.
+    :arg created: datetime of the analysis
+    :returns bytes
+    """
+    document = {
+        'format': ANALYSIS_FORMAT,
+        'version': ANALYSIS_VERSION,
+        'domain': domain,
+        'log_type': aggregate.log_type,
+        'created': created.isoformat(),
+        'aggregate': state_columns(aggregate.to_state(), counts_to_columns)
+    }
+    text = json.dumps(document, sort_keys=True, separators=(',', ':'))
+    return gzip.compress(text.encode('utf-8'), mtime=0)
+
+def load_analysis(data):
+    """
+    Read a LogAnalysis file written by dump_analysis
+    :arg data: bytes of the file
+    :returns: (LogAggregate, header dict with format, version, domain, log_type, created),
+        or (False, False) if it isn't in a known format (e.g. an old str(dict) file)
+    """
+    try:
+        document = json.loads(gzip.decompress(data))
+    except (OSError, EOFError, ValueError):
+        return False, False
+    if document.get('format') != ANALYSIS_FORMAT or document.get('version') != ANALYSIS_VERSION:
+        return False, False
+    aggregate = LogAggregate.from_state(state_columns(document.pop('aggregate'), columns_to_counts))
+    return aggregate, document
+
+def read_analysis(bucket, key):
+    """
+    Load a LogAnalysis file from S3, see load_analysis
+    """
+    analysis_file = open_s3_object(bucket, key)
+    try:
+        return load_analysis(analysis_file.read())
+    finally:
+        analysis_file.close()
+
+def rollup_from_row(row):
+    """
+    LogAggregate from a log_rollups row
+    """
+    aggregate = LogAggregate(row['log_type'], track_ips=False)
+    aggregate.hits = int(row['hits'])
+    aggregate.status = dict(json.loads(row['status']))
+    aggregate.user_agent = dict(json.loads(row['user_agents']))
+    aggregate.pages_visited = dict(json.loads(row['pages']))
+    aggregate.home_pages = dict(json.loads(row['home_pages']))
+    if row['first_date'] is not None:
+        aggregate.earliest = datetime_to_epoch(row['first_date'])
+        aggregate.latest = datetime_to_epoch(row['last_date'])
+    return aggregate
+
+def update_rollups(log_db, domain_id, log_type, hourly, subtract=False):
+    """
+    Add a file's hourly counts to the log_rollups table (or take them back
+    out). Call it in a transaction on log_db.
+    :arg log_db: db_utilities.LogDatabase
+    :arg hourly: dict of epoch hour to LogAggregate
+    """
+    if not hourly:
+        return
+    rows = log_db.get_rollups(domain_id, log_type, [epoch_to_datetime(hour) for hour in hourly])
+    existing = {datetime_to_epoch(row['hour']): row for row in rows}
+    updated = []
+    for hour, hour_aggregate in hourly.items():
+        if hour in existing:
+            rollup = rollup_from_row(existing[hour])
         else:
-            analyzed_log_data['user_agent'][log_data['user_agent']] = 1
-
-        if log_data['page_visited'] in analyzed_log_data['pages_visited']:
-            analyzed_log_data['pages_visited'][log_data['page_visited']] += 1
-            if log_type != 'azure':
-                if ((log_data['page_visited'] == '/') or
-                    (re.compile("\:[0-9]{2,3}\/$").search(log_data['page_visited']))): #home page
-                    analyzed_log_data['home_page_hits'] += 1
+            rollup = LogAggregate(log_type, track_ips=False)
+        if subtract:
+            rollup.subtract(hour_aggregate.truncated(ROLLUP_TOP))
         else:
-            analyzed_log_data['pages_visited'][log_data['page_visited']] = 1
-            if ((log_data['page_visited'] == '/') or
-                (re.compile("\:[0-9]{2,3}\/$").search(log_data['page_visited']))): #home page
-                analyzed_log_data['home_page_hits'] = 1
-
-    datetimes.sort()
-    if datetimes:
-        analyzed_log_data['earliest_date'] = datetimes[0].strftime('%d/%b/%Y:%H:%M:%S')
-        analyzed_log_data['latest_date'] = datetimes[-1].strftime('%d/%b/%Y:%H:%M:%S')
+            rollup.merge(hour_aggregate.truncated(ROLLUP_TOP))
+        rollup = rollup.truncated(ROLLUP_TOP)
+        updated.append({
+            'hour': epoch_to_datetime(hour),
+            'hits': rollup.hits,
+            'home_page_hits': rollup.home_page_hits(),
+            'status': json.dumps(list(rollup.status.items())),
+            'user_agents': json.dumps(list(rollup.user_agent.items())),
+            'pages': json.dumps(list(rollup.pages_visited.items())),
+            'home_pages': json.dumps(list(rollup.home_pages.items())),
+            'first_date': epoch_to_datetime(rollup.earliest) if rollup.earliest is not None else None,
+            'last_date': epoch_to_datetime(rollup.latest) if rollup.latest is not None else None
+        })
+    log_db.save_rollups(domain_id, log_type, updated)
+
+def save_analyzed_file(log_db, domain_id, s3_key, entry, file_aggregate):
+    """
+    Record a newly analyzed file, in one transaction: its manifest entry,
+    and its hourly counts in the rollups.
+    What each file added to the rollups is kept in log_rollup_files, which
+    (unlike the manifest) isn't pruned to the analysis range, so a file is
+    never added twice: it's added if it's new, replaced (its old counts
+    taken out first) if its ETag or ignore settings changed, and left
+    alone if it's the same as what was added.
+    :arg log_db: db_utilities.LogDatabase
+    :arg entry: manifest entry, with etag, log_type, ignore_settings, state_version
+        and aggregate (JSON)
+    :arg file_aggregate: LogAggregate of the file (with hourly counts), or False
+    """
+    with log_db.transaction():
+        rolled_up = log_db.rollup_file(domain_id, s3_key)
+        if not (rolled_up and rolled_up['etag'] == entry['etag'] and
+                rolled_up['ignore_settings'] == entry['ignore_settings']):
+            if rolled_up:
+                update_rollups(log_db, domain_id, rolled_up['log_type'],
+                               hourly_from_state(json.loads(rolled_up['hourly'])), subtract=True)
+            else:
+                # from before log_rollup_files: what the manifest entry added
+                previous = log_db.manifest_aggregate(domain_id, s3_key)
+                if previous:
+                    previous = LogAggregate.from_state(json.loads(previous))
+                    update_rollups(log_db, domain_id, previous.log_type, previous.hourly, subtract=True)
+            hourly = file_aggregate.hourly if file_aggregate and file_aggregate.hourly else {}
+            if hourly:
+                update_rollups(log_db, domain_id, file_aggregate.log_type, hourly)
+            log_db.save_rollup_file(domain_id, s3_key, entry['etag'], entry['ignore_settings'],
+                                    entry['log_type'], json.dumps(hourly_to_state(hourly)))
+        log_db.save_manifest_entry(domain_id, s3_key, entry)
+
+def rollup_report(domain, log_type, start, end, percent=1, num=30):
+    """
+    Report for any date range from the hourly rollups, without reading logs.
+    Pages and user agents are the top ROLLUP_TOP of each hour merged, so
+    their counts are a lower bound; hits and status codes are exact.
+    :arg start, end: datetimes, end is exclusive
+    :returns: same as output(), or False if there's no data
+    """
+    domain_data = get_domain_data(domain)
+    if not domain_data:
+        return False
+    aggregate = LogAggregate(log_type, track_ips=False)
+    for row in get_log_rollups(domain_data['id'], log_type, start=start, end=end):
+        aggregate.merge(rollup_from_row(row))
+    if not aggregate.hits:
+        return False
+    return output(domain=domain, data=aggregate.to_dict(), percent=percent, num=num)
 
-    return(analyzed_log_data)
+def report_top(percent, num):
+    """
+    How many of the largest counts output() can show, for LogAggregate.to_dict:
+    the top num + 1 pages, and anything over percent of hits
+    (at most 100 / percent of them). 0 (all) if percent isn't set.
+    """
+    if percent <= 0:
+        return 0
+    return max(num + 1, math.ceil(100 / percent))
 
 def output(**kwargs):
     """
@@ -247,10 +761,17 @@ def output(**kwargs):
 
     output = f"Analysis of: {kwargs['domain']}, from {first_date} to {last_date}:\n"
     output += f"Hits: {hits}\n"
+    if analyzed_log_data.get('unique_visitors'):
+        if analyzed_log_data.get('unique_visitors_estimated'):
+            output += f"Unique visitors (estimated): {analyzed_log_data['unique_visitors']}\n"
+        else:
+            output += f"Unique visitors: {analyzed_log_data['unique_visitors']}\n"
 
     if 'visitor_ips' in analyzed_log_data:
         #logger.debug(f"Visitor IPs in data: {analyzed_log_data['visitor_ips']}")
         output += f"IP addresses: \n"
+        if 'visitor_ips_error' in analyzed_log_data:
+            output += f"(Top IP addresses only - counts may be low by up to {analyzed_log_data['visitor_ips_error']})\n"
         for data in analyzed_log_data['visitor_ips']:
             perc = analyzed_log_data['visitor_ips'][data]/analyzed_log_data['hits'] * 100
             if perc >= kwargs['percent']:
@@ -266,7 +787,9 @@ def output(**kwargs):
 
     ordered_agent_data = sorted(analyzed_log_data['user_agent'].items(),
                                 key=lambda kv: kv[1], reverse=True)
-    output += f"Number of user agents: {len(ordered_agent_data)}\n"
+    output += f"Number of user agents: {analyzed_log_data.get('user_agent_count', len(ordered_agent_data))}\n"
+    if 'user_agent_error' in analyzed_log_data:
+        output += f"(Top user agents only - counts may be low by up to {analyzed_log_data['user_agent_error']})\n"
     for (agent, number) in ordered_agent_data:
         perc = number/analyzed_log_data['hits'] * 100
         if perc >= kwargs['percent']:
@@ -274,7 +797,9 @@ def output(**kwargs):
 
     i = 0
     ordered_pages_visited = sorted(analyzed_log_data['pages_visited'].items(), key=lambda kv: kv[1], reverse=True)
-    output += f"Number of pages visited: {len(ordered_pages_visited)}\n"
+    output += f"Number of pages visited: {analyzed_log_data.get('pages_visited_count', len(ordered_pages_visited))}\n"
+    if 'pages_visited_error' in analyzed_log_data:
+        output += f"(Top pages only - counts may be low by up to {analyzed_log_data['pages_visited_error']})\n"
     output += f"Top {kwargs['num']} pages:\n"
     output += f"Home Page Hits: {home_page_hits}\n"
     for (page, number) in ordered_pages_visited:
@@ -373,7 +898,7 @@ def get_output_contents(**kwargs):
     s3simple = S3Simple(region_name=kwargs['region'],
                         bucket_name=kwargs['bucket'],
                         profile=kwargs['profile'])
-    local_file_name = kwargs['local_tmp'] + '/' + kwargs['output_file']
+    local_file_name = kwargs['local_tmp'] + '/' + os.path.basename(kwargs['output_file'])
     s3simple.download_file(file_name=kwargs['output_file'], output_file=local_file_name)
 
     with open(local_file_name) as f:
@@ -384,13 +909,16 @@ def get_output_contents(**kwargs):
 def get_file_list(**kwargs):
     """
     Get the right list of files, keyed by date
+    Looks in the domain's partition (analysis/ for 'Output', raw/ otherwise)
+    and at the top of the bucket, for files not yet migrated
     """
-    s3simple = S3Simple(region_name=kwargs['region'],
-                        bucket_name=kwargs['bucket'],
-                        profile=kwargs['profile'])
-    file_list = s3simple.s3_bucket_contents()
+    root = ANALYSIS_ROOT if kwargs['filter'] == 'Output' else RAW_ROOT
+    file_list = itertools.chain(
+        list_s3_objects(kwargs['bucket'], prefix=f"{root}/{kwargs['domain']}/"),
+        list_unpartitioned(kwargs['bucket']))
     filtered_list = []
-    for single_file in file_list:
+    for s3_object in file_list:
+        single_file = s3_object['Key']
         if (kwargs['filter'] in single_file) and (kwargs['domain'] in single_file):
             date_search = '[0-9]{2}[-][a-zA-Z]{3}-20[0-9]{2}:[0-9]{2}:[0-9]{2}:[0-9]{2}'
             match = re.search(date_search, single_file)
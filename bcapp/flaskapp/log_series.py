@@ -0,0 +1,121 @@
+"""
+Hourly traffic series for log reporting
+
+Lines are buffered as compact arrays and binned by hour with numpy,
+so a month of logs is a few hundred bins per series.
+"""
+from array import array
+import numpy as np
+
+HOUR = 3600
+# Lines buffered before they are binned
+BUFFER_SIZE = 1 << 20
+
+class HourlySeries:
+    """
+    Hits, errors (status 400 and up) and home page hits per hour.
+    Mergeable, like LogAggregate.
+    """
+    def __init__(self):
+        self.times = array('q')
+        self.statuses = array('H')
+        self.home = array('B')
+        self.start = None
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.errors = np.zeros(0, dtype=np.int64)
+        self.home_page_hits = np.zeros(0, dtype=np.int64)
+
+    def add(self, log_time, status, home):
+        """
+        Buffer a line
+        :arg log_time: epoch seconds
+        :arg status: HTTP status as an int (0 if unknown)
+        :arg home: whether it's a home page hit
+        """
+        self.times.append(log_time)
+        self.statuses.append(status)
+        self.home.append(home)
+        if len(self.times) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Bin the buffered lines
+        """
+        if not self.times:
+            return
+        times = np.frombuffer(self.times, dtype=np.int64)
+        statuses = np.frombuffer(self.statuses, dtype=np.uint16)
+        home = np.frombuffer(self.home, dtype=np.uint8).astype(bool)
+        hours = times // HOUR
+        start = int(hours.min())
+        offsets = hours - start
+        length = int(offsets.max()) + 1
+        self.add_bins(start,
+                      np.bincount(offsets, minlength=length),
+                      np.bincount(offsets[statuses >= 400], minlength=length),
+                      np.bincount(offsets[home], minlength=length))
+        self.times = array('q')
+        self.statuses = array('H')
+        self.home = array('B')
+
+    def add_bins(self, start, hits, errors, home_page_hits):
+        """
+        Add binned counts starting at hour number start (epoch hours)
+        """
+        if not len(hits):
+            return
+        if self.start is None:
+            self.start = start
+            self.hits = np.zeros(0, dtype=np.int64)
+            self.errors = np.zeros(0, dtype=np.int64)
+            self.home_page_hits = np.zeros(0, dtype=np.int64)
+        new_start = min(self.start, start)
+        new_end = max(self.start + len(self.hits), start + len(hits))
+        if (new_start, new_end) != (self.start, self.start + len(self.hits)):
+            for name in ('hits', 'errors', 'home_page_hits'):
+                grown = np.zeros(new_end - new_start, dtype=np.int64)
+                current = getattr(self, name)
+                grown[self.start - new_start:self.start - new_start + len(current)] = current
+                setattr(self, name, grown)
+            self.start = new_start
+        offset = start - self.start
+        self.hits[offset:offset + len(hits)] += hits
+        self.errors[offset:offset + len(errors)] += errors
+        self.home_page_hits[offset:offset + len(home_page_hits)] += home_page_hits
+
+    def merge(self, other):
+        """
+        Add another series into this one
+        """
+        other.flush()
+        if other.start is not None:
+            self.add_bins(other.start, other.hits, other.errors, other.home_page_hits)
+        return self
+
+    def to_state(self):
+        """
+        JSON-serializable state: the first hour (epoch seconds) and a list per series
+        """
+        self.flush()
+        if self.start is None:
+            return None
+        return {
+            'start': self.start * HOUR,
+            'hits': self.hits.tolist(),
+            'errors': self.errors.tolist(),
+            'home_page_hits': self.home_page_hits.tolist()
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Rebuild a series saved with to_state
+        """
+        series = cls()
+        if state:
+            series.add_bins(state['start'] // HOUR,
+                            np.array(state['hits'], dtype=np.int64),
+                            np.array(state['errors'], dtype=np.int64),
+                            np.array(state['home_page_hits'], dtype=np.int64))
+        return series
@@ -0,0 +1,379 @@
+"""
+Continuous shipping of local access logs to S3
+
+Follows the access logs in the paths file (the same one move_logs uses)
+and uploads new lines as they are written, in compressed chunks cut when
+they reach a size or have waited long enough. Files are tracked by device
+and inode, so a log renamed by rotation is read to its end while the new
+one is followed from its start.
+
+Offsets are saved in a state file in local_tmp. A chunk is a byte range of
+one file, named for that range, and it's written to the state before it's
+uploaded: after a restart, a chunk that may not have made it is rebuilt
+from the same bytes and put again under the same key, so no line is
+shipped twice or skipped.
+"""
+import os
+import json
+import time
+import signal
+import socket
+import hashlib
+import datetime
+import logging
+import click
+from botocore.exceptions import BotoCoreError, ClientError
+from system_utilities import get_configs
+from db_utilities import get_domain_config
+from s3_utilities import get_s3_client, partition_key, RAW_ROOT
+from log_uploads import compressor, HASH_BLOCK
+from log_names import is_compressed, is_rotated
+
+logger = logging.getLogger('logger')
+
+# State file, in local_tmp
+STATE_NAME = 'log_shipper_state.json'
+CHUNK_SIZE = 8 * 1024 * 1024
+# Bytes at the start of a file kept (hashed) to tell it from a new file with a reused inode
+FINGERPRINT_BYTES = 256
+
+class ShipperState:
+    """
+    Saved state of the shipper, kept as JSON:
+    files: '<device>:<inode>' -> domain, path, offset (where the shipped lines end),
+        fingerprint (hash of the first bytes) and the chunk being uploaded, if any
+    It's saved before and after every upload (to a temporary file, then
+    renamed over the old one).
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as state_file:
+                data = json.load(state_file)
+        except FileNotFoundError:
+            data = None
+        except ValueError:
+            logger.warning(f"Can't read shipper state {path}, starting a new one")
+            data = None
+        # no state yet: logs already there are followed from their end
+        self.new = data is None
+        self.files = (data or {}).get('files', {})
+        # files whose fingerprint was checked since the state was loaded
+        self.checked = set()
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump({'files': self.files}, state_file)
+        os.replace(temp_path, self.path)
+
+def file_id(stat):
+    return f"{stat.st_dev}:{stat.st_ino}"
+
+def watched_paths(paths_file):
+    """
+    (domain, path) pairs from the paths file, one domain|path a line
+    """
+    with open(paths_file) as pathfile:
+        lines = pathfile.read().split('\n')
+    return [tuple(line.split('|', 1)) for line in lines if line and '|' in line]
+
+def watched_logs(path):
+    """
+    Uncompressed logs for a configured path: access logs in a directory,
+    or a file and its rotated copies
+    :returns list of (path, stat, live) - live is False for rotated names,
+        which are only read to finish files already followed - or None
+        if the directory can't be listed
+    """
+    if os.path.isdir(path):
+        directory, only = path, None
+    else:
+        directory, only = os.path.dirname(path) or '.', os.path.basename(path)
+    try:
+        entries = list(os.scandir(directory))
+    except OSError as e:
+        logger.warning(f"Can't list {directory}: {e}")
+        return None
+    logs = []
+    for entry in entries:
+        if only:
+            if not entry.name.startswith(only):
+                continue
+            live = entry.name == only
+        else:
+            if 'access' not in entry.name:
+                continue
+            live = not is_rotated(entry.name)
+        if is_compressed(entry.name):
+            continue
+        try:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+        except OSError:
+            # rotated away while listing
+            continue
+        logs.append((entry.path, stat, live))
+    return logs
+
+def fingerprint(log_file, size):
+    """
+    Hash of the first bytes of a file (up to FINGERPRINT_BYTES, and size)
+    """
+    log_file.seek(0)
+    return hashlib.sha1(log_file.read(min(size, FINGERPRINT_BYTES))).hexdigest()
+
+def line_start(log_file, size):
+    """
+    Where the last (maybe unfinished) line before size starts
+    """
+    start = max(size - HASH_BLOCK, 0)
+    log_file.seek(start)
+    block = log_file.read(size - start)
+    return start + block.rfind(b'\n') + 1 if b'\n' in block else start
+
+def line_end(log_file, start, size, limit):
+    """
+    End of the last whole line between start and size, at most limit bytes
+    on (or the end of the first line, if that one is longer)
+    :returns the offset after its newline, or start if there's no whole line yet
+    """
+    log_file.seek(start)
+    position = end = start
+    stop = min(size, start + limit)
+    while position < stop:
+        block = log_file.read(min(HASH_BLOCK, stop - position))
+        if not block:
+            return end
+        newline = block.rfind(b'\n')
+        if newline >= 0:
+            end = position + newline + 1
+        position += len(block)
+    while end == start and position < size:
+        block = log_file.read(min(HASH_BLOCK, size - position))
+        if not block:
+            break
+        newline = block.find(b'\n')
+        if newline >= 0:
+            end = position + newline + 1
+        position += len(block)
+    return end
+
+def chunk_body(log_file, start, end, compress=None):
+    """
+    Bytes start to end of a file, compressed if compress is 'gz' or 'zst'
+    """
+    compress_object = compressor(compress) if compress else None
+    body = bytearray()
+    log_file.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = log_file.read(min(HASH_BLOCK, remaining))
+        if not block:
+            raise OSError(f"{log_file.name} is shorter than {end} bytes")
+        remaining -= len(block)
+        body += compress_object.compress(block) if compress else block
+    if compress:
+        body += compress_object.flush()
+    return bytes(body)
+
+def chunk_key(domain, host, id, start, end, compress, date):
+    """
+    S3 key of a chunk: the host, file and byte range make it unique
+    """
+    extension = '.' + compress if compress else ''
+    return partition_key(RAW_ROOT, domain, date,
+                         f"RawLogFile_{domain}_{date:%d-%b-%Y:%H:%M:%S}_{host}_"
+                         f"{id.replace(':', '-')}_{start}-{end}.log{extension}")
+
+def follow_logs(state, watched, from_start=False):
+    """
+    Find the logs to ship, and bring the state up to date: new logs are
+    added, renamed ones get their new path, logs that were truncated or
+    whose inode now belongs to another file start again, and logs that
+    have gone are dropped
+    :arg watched: (domain, path) pairs, see watched_paths
+    :arg from_start: follow logs found on the first run from their start, not their end
+    :returns dict of file id to (path, stat)
+    """
+    found = {}
+    unlisted = set()
+    for domain, path in watched:
+        logs = watched_logs(path)
+        if logs is None:
+            unlisted.add(path)
+            continue
+        for log_path, stat, live in logs:
+            id = file_id(stat)
+            entry = state.files.get(id)
+            if entry is None:
+                if not live:
+                    continue
+                offset = 0
+                if state.new and not from_start:
+                    with open(log_path, 'rb') as log_file:
+                        offset = line_start(log_file, stat.st_size)
+                entry = state.files[id] = {'domain': domain, 'path': log_path, 'offset': offset,
+                                           'fingerprint': None, 'pending': None}
+                state.checked.add(id)
+                logger.info(f"Following {log_path} from byte {offset}")
+            elif id not in state.checked and entry['fingerprint'] and stat.st_size >= entry['offset']:
+                with open(log_path, 'rb') as log_file:
+                    same = fingerprint(log_file, entry['offset']) == entry['fingerprint']
+                if not same:
+                    logger.warning(f"{log_path} isn't the file that was followed, starting it again")
+                    entry.update({'offset': 0, 'fingerprint': None, 'pending': None})
+            state.checked.add(id)
+            pending_end = entry['pending']['end'] if entry['pending'] else 0
+            if stat.st_size < max(entry['offset'], pending_end):
+                logger.warning(f"{log_path} was truncated, starting it again")
+                entry.update({'offset': 0, 'fingerprint': None, 'pending': None})
+            entry['path'] = log_path
+            found[id] = (log_path, stat)
+
+    for id in set(state.files) - set(found):
+        entry = state.files[id]
+        if any(entry['path'].startswith(path) for path in unlisted):
+            continue
+        if entry['pending']:
+            logger.warning(f"{entry['path']} has gone before bytes {entry['pending']['start']}-"
+                           f"{entry['pending']['end']} were shipped")
+        logger.info(f"Stopped following {entry['path']}")
+        del state.files[id]
+    state.new = False
+    state.save()
+    return found
+
+def ship_logs(state, found, waiting, chunk_size=CHUNK_SIZE, interval=300, compress='zst',
+              force=False, host=None, client=None):
+    """
+    Upload the new whole lines of each log, as chunks of up to chunk_size
+    bytes, once there's a chunk's worth or they have waited interval seconds
+    :arg found: see follow_logs
+    :arg waiting: dict of file id to when its unshipped lines were first seen, kept between calls
+    :arg force: ship every whole line now (before stopping)
+    :returns (chunks uploaded, bytes of log shipped)
+    """
+    if client is None:
+        client = get_s3_client()
+    if host is None:
+        host = socket.gethostname()
+    now = time.time()
+    chunks = shipped = 0
+    for id, (log_path, stat) in found.items():
+        entry = state.files[id]
+        size = stat.st_size
+        if size <= entry['offset'] and not entry['pending']:
+            waiting.pop(id, None)
+            continue
+        started = waiting.setdefault(id, now)
+        if not entry['pending'] and not force and size - entry['offset'] < chunk_size and now - started < interval:
+            continue
+        domain_data = get_domain_config(entry['domain'])
+        if not domain_data or not domain_data['s3_bucket']:
+            logger.debug(f"No s3 bucket for {entry['domain']}")
+            continue
+        try:
+            with open(log_path, 'rb') as log_file:
+                if file_id(os.fstat(log_file.fileno())) != id:
+                    # renamed since it was listed, next time
+                    continue
+                while True:
+                    chunk = entry['pending']
+                    if not chunk:
+                        if size <= entry['offset']:
+                            waiting.pop(id, None)
+                            break
+                        end = line_end(log_file, entry['offset'], size, chunk_size)
+                        if end == entry['offset']:
+                            break
+                        chunk = {
+                            'bucket': domain_data['s3_bucket'],
+                            'start': entry['offset'],
+                            'end': end,
+                            'compress': compress,
+                            'key': chunk_key(entry['domain'], host, id, entry['offset'], end,
+                                             compress, datetime.datetime.now())
+                        }
+                        entry['pending'] = chunk
+                        state.save()
+                    body = chunk_body(log_file, chunk['start'], chunk['end'], chunk['compress'])
+                    client.put_object(Bucket=chunk['bucket'], Key=chunk['key'], Body=body)
+                    logger.debug(f"Shipped {log_path} bytes {chunk['start']}-{chunk['end']} to {chunk['key']}")
+                    entry['offset'] = chunk['end']
+                    entry['pending'] = None
+                    if not entry['fingerprint'] or chunk['start'] < FINGERPRINT_BYTES:
+                        entry['fingerprint'] = fingerprint(log_file, entry['offset'])
+                    state.save()
+                    chunks += 1
+                    shipped += chunk['end'] - chunk['start']
+                    if not force and size - entry['offset'] < chunk_size and now - started < interval:
+                        break
+        except (BotoCoreError, ClientError, OSError) as e:
+            # the pending chunk is tried again on the next pass
+            logger.warning(f"Couldn't ship {log_path}: {e}")
+    return chunks, shipped
+
+@click.command()
+@click.option('--chunk-mb', type=int, help="Most log (MB) in a chunk. Default is 8", default=8)
+@click.option('--interval', type=int, help="Most seconds new lines wait to be shipped. Default is 300", default=300)
+@click.option('--poll', type=int, help="Seconds between looks at the logs. Default is 5", default=5)
+@click.option('--compress', type=click.Choice(['none', 'gz', 'zst']), help="Chunk compression. log_stats reads gz chunks only with --unzip. Default is zst", default='zst')
+@click.option('--from-start', is_flag=True, help="On the first run, ship what's already in the logs", default=False)
+@click.option('--once', is_flag=True, help="Ship every whole line once, then stop", default=False)
+
+def log_shipper(chunk_mb, interval, poll, compress, from_start, once):
+    """
+    Follow local access logs and ship new lines to S3 as they are written.
+    Stops on SIGTERM or SIGINT, after shipping what's been written.
+    """
+    configs = get_configs()
+    if not configs['paths']:
+        raise click.UsageError("No paths file configured")
+    compress = None if compress == 'none' else compress
+    state = ShipperState(os.path.join(configs['local_tmp'], STATE_NAME))
+    client = get_s3_client()
+    host = socket.gethostname()
+    waiting = {}
+
+    stopping = []
+    def stop(signum, frame):
+        logger.info("Stopping after shipping what's there...")
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while True:
+        force = once or bool(stopping)
+        found = follow_logs(state, watched_paths(configs['paths']), from_start)
+        chunks, shipped = ship_logs(state, found, waiting, chunk_size=chunk_mb * 1024 * 1024,
+                                    interval=interval, compress=compress, force=force,
+                                    host=host, client=client)
+        if chunks:
+            logger.info(f"Shipped {chunks} chunks ({shipped} bytes of log) from {len(found)} files")
+        if force:
+            return
+        deadline = time.time() + poll
+        while not stopping and time.time() < deadline:
+            time.sleep(min(1, poll))
+
+if __name__ == '__main__':
+    configs = get_configs()
+    log = configs['log_level']
+    logger = logging.getLogger('logger')  # instantiate clogger
+    logger.setLevel(logging.DEBUG)  # pass DEBUG and higher values to handler
+
+    ch = logging.StreamHandler()  # use StreamHandler, which prints to stdout
+    ch.setLevel(configs['log_level'])  # ch handler uses the configura
+
+    # create formatter
+    # display the function name and logging level in columnar format if
+    # logging mode is 'DEBUG'
+    formatter = logging.Formatter('[%(funcName)24s] [%(levelname)8s] %(message)s')
+
+    # add formatter to ch
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    log_shipper()
@@ -0,0 +1,210 @@
+"""
+Spill-to-disk counting for log reporting
+
+When the counts for a long range don't fit in memory, they are written
+out as runs sorted by key (under local_tmp) and the dicts are cleared.
+At the end the runs are merged k-way, adding up each key's counts, so the
+results are exact however many distinct pages, agents and IPs there are.
+"""
+import os
+import heapq
+import pickle
+import shutil
+import tempfile
+import itertools
+
+# Rough size of a dict entry with a str key and an int count, on top of the key's characters
+ENTRY_BYTES = 120
+# Records per pickled batch in a run file
+RUN_BATCH = 8192
+# Runs of a counter merged into one, so a merge never holds more files open than this
+MERGE_FAN_IN = 32
+
+class SpillBudget:
+    """
+    Memory ceiling shared by a set of SpilledCounts. When their estimated
+    size together passes it, they are all spilled to disk.
+    """
+    def __init__(self, max_bytes, directory=None):
+        """
+        :arg max_bytes: memory ceiling for the counts
+        :arg directory: where to make the spill directory (local_tmp), default is the system's
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.path = None
+        self.used = 0
+        self.spills = 0
+        self.counters = []
+        self.run_number = itertools.count()
+
+    def charge(self, size):
+        """
+        Count size more bytes in memory, spilling if that's past the ceiling
+        """
+        self.used += size
+        if self.used > self.max_bytes:
+            self.spill()
+
+    def spill(self):
+        """
+        Write every counter's in-memory counts out to runs
+        """
+        for counts in self.counters:
+            counts.spill()
+        self.used = 0
+        self.spills += 1
+
+    def run_path(self):
+        """
+        Name for a new run file
+        """
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='log_spill_', dir=self.directory)
+        return os.path.join(self.path, f"run_{next(self.run_number)}")
+
+    def close(self):
+        """
+        Delete the run files
+        """
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+        for counts in self.counters:
+            counts.runs = []
+
+def write_run(path, records):
+    """
+    Write (key, count, first seen) records, sorted by key, to a run file
+    """
+    with open(path, 'wb') as run_file:
+        records = iter(records)
+        batch = list(itertools.islice(records, RUN_BATCH))
+        while batch:
+            pickle.dump(batch, run_file, protocol=pickle.HIGHEST_PROTOCOL)
+            batch = list(itertools.islice(records, RUN_BATCH))
+
+def read_run(path):
+    """
+    Yields the records of a run file, a batch at a time
+    """
+    with open(path, 'rb') as run_file:
+        while True:
+            try:
+                yield from pickle.load(run_file)
+            except EOFError:
+                return
+
+def combine(records):
+    """
+    Add up the counts of records with the same key, from a merge sorted by key.
+    A key was first seen at the earliest of its positions.
+    """
+    for key, group in itertools.groupby(records, key=lambda record: record[0]):
+        count = 0
+        first = None
+        for _, number, seen in group:
+            count += number
+            if first is None or seen < first:
+                first = seen
+        yield key, count, first
+
+class SpilledCounts:
+    """
+    Exact counts that spill to sorted runs on disk under a SpillBudget.
+
+    Each key also keeps where it was first seen (its position in the
+    order keys were added), so results come out in the same order as
+    from a plain dict.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.counts = {}
+        self.runs = []
+        # keys added before the in-memory counts, for first seen positions
+        self.base = 0
+        budget.counters.append(self)
+
+    def add(self, key, count=1):
+        """
+        Count a key
+        """
+        number = self.counts.get(key)
+        if number is None:
+            self.counts[key] = count
+            self.budget.charge(ENTRY_BYTES + len(key))
+        else:
+            self.counts[key] = number + count
+
+    def merge(self, other):
+        """
+        Add a dict of counts (or other counts) into these
+        """
+        for key, number in other.items():
+            self.add(key, number)
+        return self
+
+    def spill(self):
+        """
+        Write the in-memory counts out as a run, sorted by key
+        """
+        if not self.counts:
+            return
+        records = sorted((key, number, self.base + position)
+                         for position, (key, number) in enumerate(self.counts.items()))
+        self.base += len(self.counts)
+        self.counts = {}
+        path = self.budget.run_path()
+        write_run(path, records)
+        self.runs.append(path)
+        if len(self.runs) >= MERGE_FAN_IN:
+            self.compact()
+
+    def compact(self):
+        """
+        Merge the runs into one
+        """
+        path = self.budget.run_path()
+        write_run(path, combine(heapq.merge(*[read_run(run) for run in self.runs])))
+        for run in self.runs:
+            os.remove(run)
+        self.runs = [path]
+
+    def merged(self):
+        """
+        Yields (key, count, first seen) for every key, sorted by key
+        """
+        in_memory = sorted((key, number, self.base + position)
+                           for position, (key, number) in enumerate(self.counts.items()))
+        return combine(heapq.merge(in_memory, *[read_run(run) for run in self.runs]))
+
+    def items(self):
+        """
+        Yields (key, count), sorted by key
+        """
+        for key, number, _ in self.merged():
+            yield key, number
+
+    def __len__(self):
+        return sum(1 for _ in self.merged())
+
+    def summary(self, top=0):
+        """
+        The top counts, in one pass over the merged runs
+        :arg top: how many to keep - the largest counts, earliest seen first among
+            equal ones, as sorting a dict by count would pick them. 0 keeps all of them.
+        :returns (dict of key to count in first seen order, number of distinct keys)
+        """
+        distinct = 0
+        kept = []
+        for key, number, seen in self.merged():
+            distinct += 1
+            entry = (number, -seen, key)
+            if not top:
+                kept.append(entry)
+            elif len(kept) < top:
+                heapq.heappush(kept, entry)
+            elif entry > kept[0]:
+                heapq.heapreplace(kept, entry)
+        kept.sort(key=lambda entry: -entry[1])
+        return {key: number for number, _, key in kept}, distinct
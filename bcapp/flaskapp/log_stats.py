@@ -4,16 +4,27 @@ Analyze server stats for specific things related to onion services
 version 0.2
 """
 import os
+import json
 import datetime
+import itertools
 import click
-import sh
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError
 import logging
 from dotenv import load_dotenv
 import sqlalchemy as db
 from system_utilities import get_configs
 from simple_AWS.s3_functions import *
-from log_reporting_utilities import analyze_file, analyze_data, output, filter_and_get_date
-from db_utilities import report_save
+from log_reporting_utilities import (analyze_file, output, filter_and_get_date, read_log_lines, LogAggregate,
+                                     save_analyzed_file, dump_analysis, open_log_object, report_top,
+                                     STATE_VERSION)
+from log_names import is_zipped
+from log_parsers import LOG_PARSERS
+from log_spill import SpillBudget
+from s3_utilities import (prefetch, partition_key, list_partition, list_unpartitioned,
+                          RAW_ROOT, ANALYSIS_ROOT)
+from db_utilities import report_save, get_domain_data, LogDatabase
 from azure_utilities import retrieve_logs
 from db_utilities import get_sys_info
 
@@ -26,11 +37,23 @@ logger = logging.getLogger('logger')
 @click.option('--daemon', is_flag=True, default=False, help="Run in daemon mode. All output goes to a file.")
 @click.option('--range', type=int, help="Days of log file age to analyze. Default is 7", default=7)
 @click.option('--domain', type=str, help="Domain to analyze. Default is 'all'", default='all')
+@click.option('--workers', type=int, help="Number of processes analyzing files in parallel. Default is 1", default=1)
+@click.option('--prefetch', 'prefetch_depth', type=int, help="Number of files to download ahead while parsing. Default is 4", default=4)
+@click.option('--prefetch-mb', type=int, help="Largest file (MB) held in memory when downloading ahead. Default is 64", default=64)
+@click.option('--top-capacity', type=int, help="Count only the top IPs, pages and user agents, keeping this many. Default is 0 (exact counts)", default=0)
+@click.option('--engine', type=click.Choice(['dict', 'columnar']), help="Counting engine. Default is dict", default='dict')
+@click.option('--local', 'local_path', type=click.Path(exists=True), help="Analyze log files at this path (file or directory) instead of S3. Needs --domain", default=None)
+@click.option('--memory-mb', type=int, help="Memory (MB) for exact counts of IPs, pages and user agents, spilling to local_tmp past it. Default is 0 (no limit)", default=0)
 
-def analyze(unzip, percent, num, daemon, range, domain):
+def analyze(unzip, percent, num, daemon, range, domain, workers, prefetch_depth, prefetch_mb, top_capacity, engine, local_path, memory_mb):
 
     import faulthandler; faulthandler.enable()
 
+    if local_path and domain == 'all':
+        raise click.UsageError("--local needs --domain")
+    if memory_mb and top_capacity:
+        raise click.UsageError("--memory-mb is for exact counts, it can't be used with --top-capacity")
+
     # update system info
     last_logfile_analysis = get_sys_info(request='last_logfile_analysis', update=True)
 
@@ -39,11 +62,11 @@ def analyze(unzip, percent, num, daemon, range, domain):
     now_string = now.strftime('%d-%b-%Y:%H:%M:%S')
 
     load_dotenv()
-    engine = db.create_engine(os.environ['DATABASE_URL'])
-    connection = engine.connect()
+    db_engine = db.create_engine(os.environ['DATABASE_URL'])
+    connection = db_engine.connect()
     metadata = db.MetaData()
 
-    domains = db.Table('domains', metadata, autoload=True, autoload_with=engine)
+    domains = db.Table('domains', metadata, autoload=True, autoload_with=db_engine)
     domains_list = []
     query = db.select([domains])
     result = connection.execute(query).fetchall()
@@ -52,123 +75,312 @@ def analyze(unzip, percent, num, daemon, range, domain):
 
 
     for dm in domains_list:
-        if ((domain == 'all') or (dm['name'] == domain)):
-            # First, is there an azure profile set?
-            if ('azure_profile' in dm) and (dm['azure_profile']):
-                logger.debug(f"Domain: {dm['name']}: Azure Profile: {dm['azure_profile']}")
-                retrieve_logs(profile_name=dm['azure_profile'], range=range, s3_bucket=dm['s3_bucket'])
-
-            try:
-                s3simple = S3Simple(region_name=configs['region'],
-                                            profile=configs['profile'],
-                                            bucket_name=dm['s3_bucket'])
-            except:
-                logger.warning(f"No bucket set for domain {dm['name']}")
-                continue
+        spill = SpillBudget(memory_mb * 1024 * 1024, configs['local_tmp']) if memory_mb else None
+        try:
+            analyze_domain(dm, configs, now, unzip, percent, num, range, domain, workers, prefetch_depth,
+                           prefetch_mb, top_capacity, engine, local_path, spill)
+        finally:
+            if spill is not None:
+                logger.debug(f"{dm['name']}: spilled counts to disk {spill.spills} times")
+                spill.close()
+
+    return
+
+def analyze_domain(dm, configs, now, unzip, percent, num, range, domain, workers, prefetch_depth,
+                   prefetch_mb, top_capacity, engine, local_path, spill=None):
+    """
+    Analyze one domain's logs (if it's one of those asked for) and save the reports
+    :arg spill: optional SpillBudget for the domain's counts, see log_spill
+    """
+    if local_path and (dm['name'] == domain):
+        # Straight from disk: no S3 reads, manifest or rollups
+        aggregates = analyze_local(local_path, dm, range, unzip, workers, top_capacity, engine, spill)
+        s3simple = None
+        if dm['s3_bucket']:
+            s3simple = S3Simple(region_name=configs['region'],
+                                profile=configs['profile'],
+                                bucket_name=dm['s3_bucket'])
+        save_reports(dm, aggregates, now, percent, num, s3simple)
+    elif not local_path and ((domain == 'all') or (dm['name'] == domain)):
+        # First, is there an azure profile set?
+        if ('azure_profile' in dm) and (dm['azure_profile']):
+            logger.debug(f"Domain: {dm['name']}: Azure Profile: {dm['azure_profile']}")
+            retrieve_logs(profile_name=dm['azure_profile'], range=range, s3_bucket=dm['s3_bucket'],
+                          domain=dm['name'], workers=workers)
 
-            # get the file list to analyze
-            # read from S3
-            #logger.debug(f"Getting files from S3 bucket {dm['s3_bucket']}...")
-            file_list = s3simple.s3_bucket_contents()
-            if not file_list:
+        try:
+            s3simple = S3Simple(region_name=configs['region'],
+                                        profile=configs['profile'],
+                                        bucket_name=dm['s3_bucket'])
+        except:
+            logger.warning(f"No bucket set for domain {dm['name']}")
+            return
+
+        # get the file list to analyze
+        # read from S3: only the days in range of the domain's partition,
+        # plus whatever is at the top of the bucket (CDN logs, unmigrated files)
+        #logger.debug(f"Getting files from S3 bucket {dm['s3_bucket']}...")
+        try:
+            file_list = list(itertools.chain(
+                list_partition(dm['s3_bucket'], RAW_ROOT, dm['name'],
+                               now - datetime.timedelta(days=range + 1), now),
+                list_unpartitioned(dm['s3_bucket'])))
+        except (BotoCoreError, ClientError) as e:
+            logger.warning(f"Can't list bucket for domain {dm['name']}: {e}")
+            return
+        if not file_list:
+            return
+        logger.debug(f"File List: {[s3_object['Key'] for s3_object in file_list]}")
+        aggregates = {parser.log_type: LogAggregate(parser.log_type, capacity=top_capacity, spill=spill)
+                      for parser in LOG_PARSERS}
+        logger.debug(f"Analyzing {dm['name']}...")
+        analyze_list = []
+        for s3_object in file_list:
+            ifile = s3_object['Key']
+            if 'LogAnalysis' in ifile:
                 continue
-            logger.debug(f"File List: {file_list}")
-            compiled_data = {
-                'nginx': [],
-                'cloudfront': [],
-                'fastly': [],
-                'azure': []
-            }
-            logger.debug(f"Analyzing {dm['name']}...")
-            for ifile in file_list:
-                if 'LogAnalysis' in ifile:
-                    continue
-                if (('.gz' in ifile or '.bz2' in ifile) and not unzip):
-                    continue
-                logger.debug(f"Processing file: {ifile}")
-                if ifile[-1] == '/':
-                    directory = configs['local_tmp'] + '/' + ifile
-                    if not os.path.isdir(directory):
-                        os.mkdir(directory)
-                    continue
-                file_date = filter_and_get_date(ifile)
-                if not file_date:
-                    logger.warning("Couldn't find date in logs!")
-                    continue
-                numdays = (now - file_date).days
-                if numdays > range:
-                    continue
+            if is_zipped(ifile) and not unzip:
+                continue
+            logger.debug(f"Processing file: {ifile}")
+            if ifile[-1] == '/':
+                continue
+            file_date = filter_and_get_date(ifile)
+            if not file_date:
+                logger.warning("Couldn't find date in logs!")
+                continue
+            numdays = (now - file_date).days
+            if numdays > range:
+                continue
+            analyze_list.append(s3_object)
+
+        # Files analyzed on an earlier run, and unchanged since, come from the manifest.
+        # Only new or changed files are read from S3.
+        domain_data = get_domain_data(dm['name'])
+        if not domain_data:
+            return
+        # Kept in the manifest's ignore_settings: cached aggregates are only used
+        # if they were counted the same way (exact, or with the same capacity)
+        ignore_settings = f"{domain_data['paths_ignore']}|{domain_data['ext_ignore']}"
+        if top_capacity:
+            ignore_settings += f"|capacity={top_capacity}"
+        with LogDatabase() as log_db:
+            manifest = log_db.manifest_entries(dm['id'])
+            fetch_list = []
+            for s3_object in analyze_list:
+                entry = manifest.get(s3_object['Key'])
+                # aggregates saved by an older version lack counts (e.g. the visitors sketch)
+                if ((not entry) or (entry['etag'] != s3_object['ETag']) or
+                    (entry['ignore_settings'] != ignore_settings) or
+                    (entry['has_aggregate'] and entry['state_version'] < STATE_VERSION)):
+                    fetch_list.append(s3_object['Key'])
+            logger.debug(f"{len(analyze_list) - len(fetch_list)} files unchanged, reading {len(fetch_list)}")
 
-                #download
-                local_path = configs['local_tmp'] + '/' + ifile
-                #logger.debug(f"Downloading ... domain: {dm['name']} to {local_path}")
-                try:
-                    s3simple.download_file(file_name=ifile, output_file=local_path)
-                except:
+            etags = {s3_object['Key']: s3_object['ETag'] for s3_object in analyze_list}
+            analyzed = set()
+            for ifile, result in analyze_s3_files(dm['s3_bucket'], fetch_list, dm['name'],
+                                                  workers, prefetch_depth, prefetch_mb, top_capacity,
+                                                  domain_data, engine):
+                if result is None: # couldn't get it, try again next time
                     continue
-                
-                # Add to aggregate
-                file_parts = ifile.split('.')
-                ext = file_parts[-1]
-                if ext == 'bz2' or ext == 'gz':
-                    if unzip:
-                        if ext == 'bz2':
-                            raw_data = str(sh.bunzip2("-k", "-c", local_path))
-                        else:
-                            raw_data = str(sh.gunzip("-k", "-c", local_path))
-                    else:
-                        continue
-                else:
-                    with open(local_path) as f:
-                        raw_data = f.read()
+                file_aggregate, log_type = result
+                entry = {
+                    'etag': etags[ifile],
+                    'log_type': log_type or '',
+                    'ignore_settings': ignore_settings,
+                    'state_version': STATE_VERSION,
+                    'aggregate': json.dumps(file_aggregate.to_state()) if file_aggregate else ''
+                }
+                # the manifest entry and the rollups change together, so a crash
+                # can't leave a file's hours added without a record of it
+                save_analyzed_file(log_db, dm['id'], ifile, entry, file_aggregate)
+                # read back from the manifest below, so only one file's counts are held at a time
+                analyzed.add(ifile)
 
-                #logger.debug(f"Files data: {raw_data}")
-                compiled_log_data, log_type = analyze_file(raw_data, dm['name'])
-                if not compiled_log_data:
-                    logger.warning("No Data!")
+            # Merge in list order, so the report doesn't depend on what was cached.
+            # Saved aggregates, new ones included, are read one file at a time.
+            for s3_object in analyze_list:
+                ifile = s3_object['Key']
+                if ifile in analyzed or manifest.get(ifile, {}).get('has_aggregate'):
+                    state = log_db.manifest_aggregate(dm['id'], ifile)
+                    file_aggregate = LogAggregate.from_state(json.loads(state)) if state else False
+                else:
+                    file_aggregate = False
+                if not file_aggregate or not file_aggregate.hits:
+                    logger.warning(f"No Data in {ifile}!")
                     continue
-                
-                compiled_data[log_type] += compiled_log_data
+                aggregates[file_aggregate.log_type].merge(file_aggregate)
 
-                #logger.debug(f"Deleting local temporary file {local_path}...")
-                os.remove(local_path)
+            log_db.prune_manifest(dm['id'], etags.keys())
 
-            for log_type in compiled_data:
-                logger.debug(f"Log type: {log_type}")
-                #logger.debug(f"Analyzed data: {compiled_data[log_type]}")
-                if not compiled_data[log_type]:
-                    continue
-                analyzed_log_data = analyze_data(compiled_data[log_type], log_type)
-                (output_text, first_date, last_date, hits, home_page_hits) = output(
-                            domain=dm['name'],
-                            data=analyzed_log_data,
-                            percent=percent,
-                            num=num)
-                logger.debug(output_text)
-
-                logger.debug("Saving log analysis file...")
-                key = 'LogAnalysis_'  + dm['name'] + '_' + log_type + '_' + now_string + '.json'
-                body = str(analyzed_log_data)
-                s3simple.put_to_s3(key=key, body=body)
-
-                logger.debug("Saving output file....")
-                key = 'LogAnalysisOutput_' + dm['name'] + '_' + log_type + '_' + now_string + '.txt'
-                s3simple.put_to_s3(key=key, body=output_text)
-
-                logger.debug("Sending Report to Database...")
-                report_save(
+        save_reports(dm, aggregates, now, percent, num, s3simple)
+
+    return
+
+def save_reports(dm, aggregates, now, percent, num, s3simple=None):
+    """
+    Write the report for each log type with hits: analysis and output files
+    to the domain's bucket (if s3simple is given), and the report to the database
+    """
+    now_string = now.strftime('%d-%b-%Y:%H:%M:%S')
+    for log_type in aggregates:
+        logger.debug(f"Log type: {log_type}")
+        if not aggregates[log_type].hits:
+            continue
+        analyzed_log_data = aggregates[log_type].to_dict(top=report_top(percent, num))
+        (output_text, first_date, last_date, hits, home_page_hits) = output(
                     domain=dm['name'],
-                    datetime=now,
-                    report_text=output_text,
-                    hits=hits,
-                    home_page_hits=home_page_hits,
-                    first_date_of_log=first_date,
-                    last_date_of_log=last_date,
-                    log_type=log_type
-                    )
+                    data=analyzed_log_data,
+                    percent=percent,
+                    num=num)
+        logger.debug(output_text)
+
+        if s3simple is not None:
+            logger.debug("Saving log analysis file...")
+            key = partition_key(ANALYSIS_ROOT, dm['name'], now,
+                                'LogAnalysis_'  + dm['name'] + '_' + log_type + '_' + now_string + '.json.gz')
+            body = dump_analysis(aggregates[log_type], dm['name'], now)
+            s3simple.put_to_s3(key=key, body=body)
+
+            logger.debug("Saving output file....")
+            key = partition_key(ANALYSIS_ROOT, dm['name'], now,
+                                'LogAnalysisOutput_' + dm['name'] + '_' + log_type + '_' + now_string + '.txt')
+            s3simple.put_to_s3(key=key, body=output_text)
+
+        logger.debug("Sending Report to Database...")
+        report_save(
+            domain=dm['name'],
+            datetime=now,
+            report_text=output_text,
+            hits=hits,
+            home_page_hits=home_page_hits,
+            first_date_of_log=first_date,
+            last_date_of_log=last_date,
+            log_type=log_type,
+            unique_visitors=analyzed_log_data.get('unique_visitors'),
+            visitor_sketch=analyzed_log_data.get('visitor_sketch'),
+            hourly_series=json.dumps(analyzed_log_data['hourly_series']) if 'hourly_series' in analyzed_log_data else None
+            )
 
     return
 
+def list_local_logs(path, range, unzip):
+    """
+    Log files to analyze under a local path: access logs modified in the
+    last range days (gzip and bzip2 ones only with unzip), in name order
+    """
+    if not os.path.isdir(path):
+        return [path]
+    now = datetime.datetime.now()
+    file_list = []
+    for directory, dirs, files in os.walk(path):
+        for file_name in files:
+            full_path = os.path.join(directory, file_name)
+            if 'access' not in file_name:
+                continue
+            if is_zipped(file_name) and not unzip:
+                continue
+            modified = datetime.datetime.fromtimestamp(os.path.getmtime(full_path))
+            if (now - modified).days > range:
+                continue
+            file_list.append(full_path)
+    return sorted(file_list)
+
+def analyze_local(path, dm, range, unzip, workers, capacity=0, engine='dict', spill=None):
+    """
+    Reduce the log files under a local path to one aggregate per log type
+    :arg spill: optional SpillBudget, see LogAggregate
+    :returns dict of log type to LogAggregate
+    """
+    aggregates = {parser.log_type: LogAggregate(parser.log_type, capacity=capacity, spill=spill)
+                  for parser in LOG_PARSERS}
+    domain_data = get_domain_data(dm['name'])
+    if not domain_data:
+        return aggregates
+    file_list = list_local_logs(path, range, unzip)
+    logger.debug(f"Local files: {file_list}")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(analyze_local_file, file_list,
+                                    itertools.repeat(dm['name']),
+                                    itertools.repeat(capacity),
+                                    itertools.repeat(domain_data),
+                                    itertools.repeat(engine)))
+    else:
+        results = (analyze_local_file(file_name, dm['name'], capacity, domain_data, engine) for file_name in file_list)
+    for file_name, (file_aggregate, log_type) in zip(file_list, results):
+        if not file_aggregate or not file_aggregate.hits:
+            logger.warning(f"No Data in {file_name}!")
+            continue
+        aggregates[log_type].merge(file_aggregate)
+    return aggregates
+
+def analyze_local_file(file_name, domain, capacity=0, domain_data=None, engine='dict'):
+    """
+    Reduce one local log file to an aggregate, using the same parsers as
+    for S3. Uncompressed files are memory-mapped, compressed (.gz, .bz2, .zst) ones
+    are decompressed as they stream.
+    :returns: (LogAggregate, log type) - (False, False) if it isn't a log file
+    """
+    return analyze_file(read_log_lines(file_name), domain, domain_data=domain_data,
+                        capacity=capacity, engine=engine)
+
+def analyze_s3_files(bucket, file_list, domain, workers, prefetch_depth, prefetch_mb, capacity=0,
+                     domain_data=None, engine='dict'):
+    """
+    Reduce S3 log files to aggregates, in parallel processes if workers > 1.
+    In a single process the next files are downloaded in threads while
+    the current one is parsed.
+    domain_data is handed to the workers, so they don't go to the database.
+    :yields (file name, result of analyze_s3_file) in the order of file_list
+    """
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(analyze_s3_file,
+                               itertools.repeat(bucket),
+                               file_list,
+                               itertools.repeat(domain),
+                               itertools.repeat(None),
+                               itertools.repeat(capacity),
+                               itertools.repeat(domain_data),
+                               itertools.repeat(engine))
+            yield from zip(file_list, results)
+    else:
+        fetch = functools.partial(open_log_object, bucket, domain=domain, domain_data=domain_data,
+                                  max_buffer=prefetch_mb * 1024 * 1024)
+        for ifile, future in prefetch(fetch, file_list, prefetch_depth):
+            yield ifile, analyze_s3_file(bucket, ifile, domain, prefetched=future, capacity=capacity,
+                                         domain_data=domain_data, engine=engine)
+
+def analyze_s3_file(bucket, ifile, domain, prefetched=None, capacity=0, domain_data=None, engine='dict'):
+    """
+    Read one log file from S3 and reduce it to an aggregate.
+    The file is sniffed from its first bytes first, and only downloaded
+    if it's one of the domain's logs (see open_log_object).
+    The body is streamed into the decoder, nothing is written to local_tmp.
+    :arg prefetched: optional future from prefetch() holding the opened object
+    :arg capacity: count pages and agents approximately, see LogAggregate
+    :arg domain_data: optional domain settings, looked up (once per process) if not given
+    :arg engine: 'dict' or 'columnar', see analyze_file
+    :returns: (LogAggregate, log type) - (False, False) if it isn't a log file,
+        None if the file couldn't be read
+    """
+    try:
+        if prefetched is None:
+            log_stream = open_log_object(bucket, ifile, domain, domain_data)
+        else:
+            log_stream = prefetched.result()
+    except (BotoCoreError, ClientError) as e:
+        logger.warning(f"Couldn't get {ifile}: {e}")
+        return None
+    if log_stream is None:
+        return False, False
+
+    try:
+        return analyze_file(read_log_lines(ifile, log_stream), domain, domain_data=domain_data,
+                            hourly=True, capacity=capacity, engine=engine)
+    finally:
+        log_stream.close()
+
 if __name__ == '__main__':
     configs = get_configs()
     log = configs['log_level']
@@ -0,0 +1,395 @@
+"""
+Uploads of local log files to S3, for move_logs (and streamed
+uploads, for copies from Azure)
+
+Each file's content is hashed (SHA-256, decompressed for .gz, .bz2 and
+.zst files), and the hash is recorded in a local manifest once the file
+is in the bucket, so the same log is never shipped twice, whatever it's
+called by then, compressed or not. Large files go up as
+multipart uploads; an interrupted upload is picked up where it stopped
+on the next run. Uncompressed logs can be gzip or zstd compressed as
+they are read, so only the compressed bytes go over the wire.
+"""
+import os
+import bz2
+import gzip
+import zlib
+import json
+import hashlib
+import itertools
+import datetime
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import zstandard
+from botocore.exceptions import BotoCoreError, ClientError
+from s3_utilities import get_s3_client
+
+logger = logging.getLogger('logger')
+
+# Manifest file, in local_tmp
+MANIFEST_NAME = 'move_logs_manifest.json'
+# Files this big or bigger are uploaded in parts
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+# S3's smallest part size (except for the last part)
+MIN_PART_SIZE = 5 * 1024 * 1024
+HASH_BLOCK = 1024 * 1024
+
+def open_decompressed(path):
+    """
+    Open a gzip, bzip2 or zstd compressed file to read its content
+    :returns binary file object, or None if path isn't compressed
+    """
+    extension = path.rsplit('.', 1)[-1]
+    if extension == 'gz':
+        return gzip.open(path, 'rb')
+    if extension == 'bz2':
+        return bz2.open(path, 'rb')
+    if extension == 'zst':
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return None
+
+class UploadManifest:
+    """
+    Local record of what move_logs has shipped, kept as JSON:
+    shipped: '<bucket>/<content hash>' -> key, size and date of the upload
+    uploads: '<bucket>/<content hash>' -> multipart upload in progress (key, upload id, part size)
+    hashes: path -> [size, mtime, inode, hash], so unchanged files aren't read again
+    It's saved whenever an upload starts or finishes (to a temporary file,
+    then renamed over the old one), so a killed run loses nothing but cached hashes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        try:
+            with open(path) as manifest_file:
+                data = json.load(manifest_file)
+        except FileNotFoundError:
+            data = {}
+        except ValueError:
+            logger.warning(f"Can't read upload manifest {path}, starting a new one")
+            data = {}
+        self.shipped = data.get('shipped', {})
+        self.uploads = data.get('uploads', {})
+        self.hashes = data.get('hashes', {})
+        # hashes of the files seen on this run
+        self.seen = set()
+
+    def save(self):
+        with self.lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as manifest_file:
+                json.dump({'shipped': self.shipped, 'uploads': self.uploads, 'hashes': self.hashes}, manifest_file)
+            os.replace(temp_path, self.path)
+
+    def file_digest(self, path):
+        """
+        Content hash of a local file, only read if it changed since it was last hashed.
+        Compressed files are hashed decompressed, so a rotation compressed
+        by logrotate (delaycompress) matches the plain copy already shipped.
+        :returns (hex digest, size hashed)
+        """
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        with self.lock:
+            cached = self.hashes.get(path)
+        if cached and cached[:3] == signature:
+            with self.lock:
+                self.seen.add(cached[3])
+            return cached[3], stat.st_size
+        digest = hashlib.sha256()
+        remaining = stat.st_size
+        decompressed = open_decompressed(path)
+        if decompressed is not None:
+            # rotated and compressed, so not growing: all of it
+            try:
+                with decompressed as log_file:
+                    for block in iter(lambda: log_file.read(HASH_BLOCK), b''):
+                        digest.update(block)
+            except (EOFError, zlib.error, zstandard.ZstdError) as e:
+                # most likely still being compressed; try again next run
+                raise OSError(f"Can't decompress {path}: {e}")
+            remaining = 0
+        else:
+            with open(path, 'rb') as log_file:
+                # only what's there now, in case it's still being written
+                while remaining > 0:
+                    block = log_file.read(min(HASH_BLOCK, remaining))
+                    if not block:
+                        break
+                    digest.update(block)
+                    remaining -= len(block)
+        # a cache, so saved with the next upload rather than for every file
+        with self.lock:
+            self.hashes[path] = signature + [digest.hexdigest()]
+            self.seen.add(digest.hexdigest())
+        return digest.hexdigest(), stat.st_size - remaining
+
+    def start_upload(self, entry, upload):
+        with self.lock:
+            self.uploads[entry] = upload
+            self.save()
+
+    def mark_shipped(self, entry, key, size):
+        with self.lock:
+            self.uploads.pop(entry, None)
+            self.shipped[entry] = {'key': key, 'size': size, 'date': datetime.datetime.now().isoformat()}
+            self.save()
+
+    def forget_hashes(self, paths):
+        """
+        Drop cached hashes of files that weren't seen (rotated away or deleted)
+        """
+        with self.lock:
+            for path in set(self.hashes) - set(paths):
+                del self.hashes[path]
+            self.save()
+
+    def abort_unseen(self, client=None):
+        """
+        Abort the multipart uploads of content that wasn't seen on this run
+        (a log that was still growing, or has gone), so their parts aren't kept
+        """
+        if client is None:
+            client = get_s3_client()
+        with self.lock:
+            unseen = {entry: upload for entry, upload in self.uploads.items()
+                      if entry.rsplit('/', 1)[1] not in self.seen}
+        for entry, upload in unseen.items():
+            bucket = entry.rsplit('/', 1)[0]
+            try:
+                client.abort_multipart_upload(Bucket=bucket, Key=upload['key'], UploadId=upload['upload_id'])
+            except ClientError as e:
+                logger.debug(f"Couldn't abort upload to {upload['key']}: {e}")
+            with self.lock:
+                self.uploads.pop(entry, None)
+        if unseen:
+            self.save()
+
+def compressor(compress):
+    """
+    Streaming compressor (with compress and flush) for 'gz' or 'zst'.
+    The gzip header has no time or name in it, so a file always
+    compresses to the same bytes, and an upload can be resumed.
+    """
+    if compress == 'gz':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compress == 'zst':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    raise ValueError(f"Unknown compression: {compress}")
+
+def file_blocks(path, size):
+    """
+    Yields the first size bytes of a file, a block at a time
+    """
+    remaining = size
+    with open(path, 'rb') as log_file:
+        while remaining > 0:
+            block = log_file.read(min(HASH_BLOCK, remaining))
+            if not block:
+                return
+            remaining -= len(block)
+            yield block
+
+def split_parts(blocks, part_size):
+    """
+    Yields the bytes of blocks (of any size) in parts of part_size bytes,
+    the last one shorter. Only about one part is held in memory.
+    """
+    buffer = bytearray()
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+def compressed_blocks(blocks, compress):
+    """
+    Yields blocks compressed with compressor(compress)
+    """
+    compress_object = compressor(compress)
+    for block in blocks:
+        yield compress_object.compress(block)
+    yield compress_object.flush()
+
+def file_parts(path, size, part_size, compress=None):
+    """
+    Yields the first size bytes of a file in parts of part_size bytes
+    (the last one shorter, but never empty), compressed on the way if
+    compress is set. Only about one part is held in memory.
+    """
+    blocks = file_blocks(path, size)
+    if compress:
+        blocks = compressed_blocks(blocks, compress)
+    parts = split_parts(blocks, part_size)
+    # an empty file is one empty part
+    yield next(parts, b'')
+    yield from parts
+
+def multipart_upload(bucket, key, path, size, entry, manifest, part_size=PART_SIZE, compress=None,
+                     parts_iter=None, client=None):
+    """
+    Upload the first size bytes of a file in parts, carrying on with an
+    earlier upload of the same content if there is one.
+    The parts already in S3 are listed from S3, so none are sent twice
+    (compressed parts are still compressed again, to find where the next part starts).
+    :arg compress: None, 'gz' or 'zst', see file_parts
+    :arg parts_iter: optional file_parts(path, size, part_size, compress) already
+        started, for a new upload
+    :returns bytes sent
+    """
+    if client is None:
+        client = get_s3_client()
+    upload = manifest.uploads.get(entry)
+    parts = {}
+    if upload and upload.get('compress') != compress:
+        # different bytes, the parts don't fit together
+        try:
+            client.abort_multipart_upload(Bucket=bucket, Key=upload['key'], UploadId=upload['upload_id'])
+        except ClientError as e:
+            logger.debug(f"Couldn't abort upload to {upload['key']}: {e}")
+        upload = None
+    if upload:
+        try:
+            paginator = client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=bucket, Key=upload['key'], UploadId=upload['upload_id']):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = part['ETag']
+            logger.info(f"Resuming upload of {path} to {upload['key']}: {len(parts)} parts done")
+        except ClientError as e:
+            # expired or aborted, start again
+            logger.debug(f"Can't resume upload of {path}: {e}")
+            upload = None
+    if not upload:
+        response = client.create_multipart_upload(Bucket=bucket, Key=key)
+        upload = {
+            'key': key,
+            'upload_id': response['UploadId'],
+            'part_size': part_size,
+            'compress': compress,
+            'started': datetime.datetime.now().isoformat()
+        }
+        manifest.start_upload(entry, upload)
+    else:
+        parts_iter = None
+    key = upload['key']
+    if parts_iter is None:
+        parts_iter = file_parts(path, size, upload['part_size'], compress)
+
+    sent = 0
+    for number, body in enumerate(parts_iter, 1):
+        if number in parts:
+            continue
+        response = client.upload_part(Bucket=bucket, Key=key, UploadId=upload['upload_id'],
+                                      PartNumber=number, Body=body)
+        parts[number] = response['ETag']
+        sent += len(body)
+    client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload['upload_id'],
+                                     MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': parts[number]}
+                                                                for number in sorted(parts)]})
+    return sent
+
+def ship_file(bucket, path, key, manifest, part_size=PART_SIZE, compress=None, client=None):
+    """
+    Upload a local file, unless the same content is already in the bucket
+    :arg key: S3 key to use, if it's new
+    :arg compress: None, or 'gz' or 'zst' to compress it while uploading
+        (key should end in the matching extension)
+    :returns bytes sent (0 if it was already shipped)
+    """
+    if client is None:
+        client = get_s3_client()
+    digest, size = manifest.file_digest(path)
+    entry = f"{bucket}/{digest}"
+    if entry in manifest.shipped:
+        logger.debug(f"Already shipped: {path}")
+        return 0
+    if entry in manifest.uploads:
+        key = manifest.uploads[entry]['key']
+        sent = multipart_upload(bucket, key, path, size, entry, manifest, part_size, compress, client=client)
+    elif compress:
+        # the compressed size isn't known until it's done: one put if it fits in a part
+        parts_iter = file_parts(path, size, part_size, compress)
+        body = next(parts_iter)
+        second = next(parts_iter, None)
+        if second is None:
+            client.put_object(Bucket=bucket, Key=key, Body=body)
+            sent = len(body)
+        else:
+            sent = multipart_upload(bucket, key, path, size, entry, manifest, part_size, compress,
+                                    parts_iter=itertools.chain((body, second), parts_iter), client=client)
+    elif size >= MULTIPART_THRESHOLD:
+        sent = multipart_upload(bucket, key, path, size, entry, manifest, part_size, client=client)
+    else:
+        with open(path, 'rb') as log_file:
+            body = log_file.read(size)
+        client.put_object(Bucket=bucket, Key=key, Body=body)
+        sent = len(body)
+    manifest.mark_shipped(entry, key, size)
+    logger.debug(f"Shipped {path} to {key}: {sent} bytes")
+    return sent
+
+def stream_upload(bucket, key, blocks, part_size=PART_SIZE, client=None):
+    """
+    Upload bytes from an iterable of blocks (of any size, a download say)
+    without holding more than about one part: in one put if they come to
+    no more than a part, as a multipart upload if not. A multipart upload
+    that fails is aborted.
+    :returns bytes sent
+    """
+    if client is None:
+        client = get_s3_client()
+    parts = split_parts(blocks, part_size)
+    body = next(parts, b'')
+    second = next(parts, None)
+    if second is None:
+        client.put_object(Bucket=bucket, Key=key, Body=body)
+        return len(body)
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    try:
+        etags = []
+        sent = 0
+        for number, body in enumerate(itertools.chain((body, second), parts), 1):
+            response = client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                          PartNumber=number, Body=body)
+            etags.append({'PartNumber': number, 'ETag': response['ETag']})
+            sent += len(body)
+        client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                         MultipartUpload={'Parts': etags})
+    except Exception:
+        try:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except ClientError as e:
+            logger.debug(f"Couldn't abort upload to {key}: {e}")
+        raise
+    return sent
+
+def ship_files(jobs, manifest, workers=4, part_size=PART_SIZE, client=None):
+    """
+    Upload files in a thread pool, see ship_file
+    :arg jobs: list of (bucket, local path, key, compression or None)
+    :returns (files uploaded, bytes sent, files that failed)
+    """
+    if client is None:
+        client = get_s3_client()
+
+    def ship(job):
+        bucket, path, key, compress = job
+        try:
+            return ship_file(bucket, path, key, manifest, part_size, compress, client=client)
+        except (BotoCoreError, ClientError, OSError) as e:
+            logger.warning(f"Couldn't ship {path}: {e}")
+            return None
+
+    uploaded = sent = failed = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for result in pool.map(ship, jobs):
+            if result is None:
+                failed += 1
+            elif result:
+                uploaded += 1
+                sent += result
+    return uploaded, sent, failed
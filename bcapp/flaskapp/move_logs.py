@@ -1,26 +1,35 @@
 import sys
 import os
+import json
 import datetime
 import time
 import click
 import sh
 import logging
-from dotenv import load_dotenv
-import sqlalchemy as db
 from system_utilities import get_configs
-from simple_AWS.s3_functions import *
+from db_utilities import get_domain_config
+from s3_utilities import partition_key, RAW_ROOT
+from log_uploads import UploadManifest, ship_files, MANIFEST_NAME, MIN_PART_SIZE
+from log_names import COMPRESSED_EXTENSIONS, is_rotated
 
 logger = logging.getLogger('logger')
 
+# Directory listings from the last run, in local_tmp
+MARKS_NAME = 'move_logs_directories.json'
+
 @click.command()
 @click.option('--daemon', is_flag=True, default=False, help="Run in daemon mode. All output goes to a file.")
 @click.option('--zip', is_flag=True, help="Save zipped log files", default=False)
 @click.option('--recursive', is_flag=True, help="Descent through directories")
 @click.option('--range', type=int, help="Days of log file age to save. Default is 7", default=7)
+@click.option('--workers', type=int, help="Files uploaded at once. Default is 4", default=4)
+@click.option('--part-mb', type=int, help="Part size (MB) for multipart uploads. Default is 16", default=16)
+@click.option('--compress', type=click.Choice(['none', 'gz', 'zst']), help="Compress uncompressed logs while uploading. log_stats reads zst uploads as they are, gz ones only with --unzip. Default is none", default='none')
 
-def move_logs(daemon, zip, recursive, range):
+def move_logs(daemon, zip, recursive, range, workers, part_mb, compress):
     """
-    Move logs from local to s3
+    Move logs from local to s3.
+    Files already shipped (same content) are skipped, see log_uploads.
     """
     configs = get_configs()
     now = datetime.datetime.now()
@@ -33,77 +42,152 @@ def move_logs(daemon, zip, recursive, range):
             raw_path_list = pathfile.read()
         paths = raw_path_list.split('\n')
 
+    manifest = UploadManifest(os.path.join(configs['local_tmp'], MANIFEST_NAME))
+    marks = DirectoryMarks(os.path.join(configs['local_tmp'], MARKS_NAME))
+    jobs = []
     for fpath in paths:
         if not fpath:
             continue
         domain, path = fpath.split('|')
 
-        load_dotenv()
-        engine = db.create_engine(os.environ['DATABASE_URL'])
-        connection = engine.connect()
-        metadata = db.MetaData()
-
-        domains = db.Table('domains', metadata, autoload=True, autoload_with=engine)
-        domains_list = []
-        query = db.select([domains])
-        result = connection.execute(query).fetchall()
-        for line in result:
-            domains_list.append({'id' : line[0], 'name' : line[1], 's3_bucket' : line[4]})
-
-        domain_match = False
-        for db_domain in domains_list:
-            if ((db_domain['name'] == domain) and (db_domain['s3_bucket'])):
-                domain_match = True
-                s3simple = S3Simple(region_name=configs['region'],
-                                profile=configs['profile'],
-                                bucket_name=db_domain['s3_bucket'])
-
-        if not domain_match:
-            logger_debug("No s3 bucket match!")
+        domain_data = get_domain_config(domain)
+        if not domain_data or not domain_data['s3_bucket']:
+            logger.debug("No s3 bucket match!")
             continue
 
         if not os.path.exists(path):
             logger.critical("Path doesn't exist!")
             return
         if not os.path.isdir(path):
-            files = [path]
+            files = [path] if 'access' in path else []
         else:
-            files = get_list(path, recursive, range)
+            files = get_list(path, recursive, range, marks)
 
         logger.debug(f"Path: {path}")
 
-        # send to S3
         for file_name in files:
-            if 'access' not in file_name:
-                    continue
             file_path = file_name.split('/')
             file_parts = file_path[-1].split('.')
             just_file_name = '.'.join(file_path)
             logger.debug(f"File Name {just_file_name}")
             ext = file_parts[-1]
-            if ((ext == 'bz2' or ext == 'gz')) and not zip:
+            if (ext in COMPRESSED_EXTENSIONS) and not zip:
                 continue 
-            logger.debug("sending to s3...")
-            s3_file =  'RawLogFile_' + domain + '_' + now_string + '_' + just_file_name
-            s3simple.send_file_to_s3(local_file=file_name, s3_file=s3_file)
+            s3_file = partition_key(RAW_ROOT, domain, now,
+                                    'RawLogFile_' + domain + '_' + now_string + '_' + just_file_name)
+            file_compress = None
+            if compress != 'none' and ext not in COMPRESSED_EXTENSIONS:
+                file_compress = compress
+                s3_file += '.' + compress
+            jobs.append((domain_data['s3_bucket'], file_name, s3_file, file_compress))
+
+    # send to S3
+    logger.debug(f"Sending {len(jobs)} files to s3...")
+    uploaded, sent, failed = ship_files(jobs, manifest, workers=workers,
+                                        part_size=max(part_mb * 1024 * 1024, MIN_PART_SIZE))
+    logger.info(f"Uploaded {uploaded} files ({sent} bytes), {len(jobs) - uploaded - failed} already shipped, {failed} failed")
+    if not failed:
+        # leave interrupted uploads alone if this run didn't get to them
+        manifest.abort_unseen()
+    manifest.forget_hashes([job[1] for job in jobs])
+    marks.save()
+
+class DirectoryMarks:
+    """
+    What each log directory held on the last run, kept as JSON:
+    directory -> its mtime, when it was listed, and its entries (name -> [inode, is a directory, mtime])
+    A directory whose mtime hasn't moved since it was listed has the same
+    entries, so it isn't listed again. Files under rotated names (see
+    is_rotated) aren't written to any more, so they are only statted the
+    first time their inode is seen; only live logs and subdirectories are
+    statted every run. Files that aren't access logs aren't statted at all
+    (their mtime is 0).
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as marks_file:
+                self.marks = json.load(marks_file)
+        except FileNotFoundError:
+            self.marks = {}
+        except ValueError:
+            logger.warning(f"Can't read directory marks {path}, starting again")
+            self.marks = {}
+        # directories listed on this run, the only ones saved
+        self.visited = {}
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as marks_file:
+            json.dump(self.visited, marks_file)
+        os.replace(temp_path, self.path)
+
+    def entries(self, directory):
+        """
+        A directory's entries, name -> [inode, is a directory, mtime (ns)]
+        """
+        stat = os.stat(directory)
+        mark = self.marks.get(directory)
+        # an mtime within a second of the listing may hide a change made just after it
+        if mark and mark['mtime'] == stat.st_mtime_ns and stat.st_mtime < mark['listed'] - 1:
+            entries = mark['entries']
+            for name, entry in entries.items():
+                # a subdirectory's mtime moves without this one's, and get_list ages them too
+                if entry[1] or (not is_rotated(name) and 'access' in os.path.join(directory, name)):
+                    try:
+                        entry[2] = os.stat(os.path.join(directory, name)).st_mtime_ns
+                    except FileNotFoundError:
+                        pass
+            self.visited[directory] = mark
+            return entries
+
+        listed = time.time()
+        # settled files from the last listing, by inode, in case they were renamed
+        known = {}
+        if mark:
+            known = {entry[0]: entry[2] for name, entry in mark['entries'].items()
+                     if not entry[1] and is_rotated(name)}
+        entries = {}
+        with os.scandir(directory) as scan:
+            for entry in scan:
+                try:
+                    is_dir = entry.is_dir()
+                    if not is_dir and not entry.is_file():
+                        continue
+                    inode = entry.inode()
+                    if not is_dir and 'access' not in entry.path:
+                        mtime = 0
+                    elif not is_dir and is_rotated(entry.name) and inode in known:
+                        mtime = known[inode]
+                    else:
+                        mtime = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    # rotated away while listing
+                    continue
+                entries[entry.name] = [inode, is_dir, mtime]
+        self.visited[directory] = {'mtime': stat.st_mtime_ns, 'listed': listed, 'entries': entries}
+        return entries
 
-def get_list(path, recursive, range):
-    now = datetime.datetime.now()
-    file_list = os.listdir(path)
-    all_files = []
-    for entry in file_list:
-        full_path = os.path.join(path, entry)
-        # How old is the file?
-        modified = datetime.datetime.fromtimestamp(os.path.getmtime(full_path))
-        numdays = (now - modified).days
-        logger.debug(f"File: {full_path} Age: {numdays}")
-        if numdays > range:
+def get_list(path, recursive, range, marks):
+    """
+    Walk a log directory
+    :arg range: days of age to keep, files (and directories) modified longer ago are skipped
+    :arg marks: DirectoryMarks, so repeat runs only stat what may have changed
+    :yields paths of access logs
+    """
+    # (now - modified).days > range
+    oldest = time.time_ns() - (range + 1) * 86400 * 10**9
+    for name, (_, is_dir, mtime) in marks.entries(path).items():
+        full_path = os.path.join(path, name)
+        if not is_dir and 'access' not in full_path:
+            continue
+        if mtime <= oldest:
             continue
-        if os.path.isdir(full_path) and recursive:
-            all_files = all_files + get_list(full_path, recursive)
+        if is_dir:
+            if recursive:
+                yield from get_list(full_path, recursive, range, marks)
         else:
-            all_files.append(full_path)
-    return all_files
+            yield full_path
 
 if __name__ == '__main__':
     configs = get_configs()
@@ -10,7 +10,7 @@ from dotenv import load_dotenv
 import sqlalchemy as db
 from system_utilities import get_configs, send_email
 from repo_utilities import site_match
-from db_utilities import get_sys_info
+from db_utilities import get_sys_info, invalidate_domain_cache
 import boto3
 
 logger = logging.getLogger('logger')
@@ -313,6 +313,7 @@ def send_report(domain_data, mode):
         insert = domains.insert().values(domain=domain_data['domain'])
         result = connection.execute(insert)
         domain_id = result.inserted_primary_key[0]
+        invalidate_domain_cache()
         logger.debug(f"Domain ID: {domain_id}")
     
     # Add mirrors
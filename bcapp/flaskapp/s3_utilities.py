@@ -0,0 +1,151 @@
+"""
+S3 utilities for the log pipeline
+
+Direct boto3 access for the things simple_AWS doesn't do:
+streaming object bodies and reading ahead while earlier files are parsed
+"""
+import io
+import datetime
+import itertools
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.exceptions import ClientError
+from system_utilities import get_configs
+
+logger = logging.getLogger('logger')
+
+# Top level prefixes of the partitioned layout, see partition_key
+RAW_ROOT = 'raw'
+ANALYSIS_ROOT = 'analysis'
+
+s3_clients = {}
+s3_clients_lock = threading.Lock()
+
+def get_s3_client():
+    """
+    Get a boto3 S3 client for the configured profile and region.
+    Clients are thread safe, so one is shared per process.
+    """
+    configs = get_configs()
+    client_key = (configs['profile'], configs['region'])
+    with s3_clients_lock:
+        if client_key not in s3_clients:
+            session = boto3.Session(profile_name=configs['profile'])
+            s3_clients[client_key] = session.client('s3', region_name=configs['region'])
+    return s3_clients[client_key]
+
+def list_s3_objects(bucket, prefix='', client=None, start_after='', delimiter=''):
+    """
+    List the objects in a bucket, following pagination
+    :arg start_after: only keys after this one
+    :arg delimiter: if set, keys containing it after the prefix are left out
+    :yields dicts with Key, ETag, Size and LastModified
+    """
+    if client is None:
+        client = get_s3_client()
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**kwargs):
+        for s3_object in page.get('Contents', []):
+            yield s3_object
+
+def partition_key(root, domain, date, file_name):
+    """
+    Key in the partitioned layout: <root>/<domain>/<yyyy>/<mm>/<dd>/<file name>
+    :arg root: RAW_ROOT or ANALYSIS_ROOT
+    """
+    return f"{root}/{domain}/{date:%Y/%m/%d}/{file_name}"
+
+def list_partition(bucket, root, domain, start, end, client=None):
+    """
+    List a domain's partitioned objects from the start date to the end date
+    (inclusive), in one listing that starts at the first day and stops after the last
+    :yields dicts with Key, ETag, Size and LastModified
+    """
+    prefix = f"{root}/{domain}/"
+    # every key of the start day sorts after this, every key before it sorts first
+    start_after = f"{prefix}{start:%Y/%m/%d}"
+    stop_at = partition_key(root, domain, end + datetime.timedelta(days=1), '')
+    for s3_object in list_s3_objects(bucket, prefix, client=client, start_after=start_after):
+        if s3_object['Key'] >= stop_at:
+            return
+        yield s3_object
+
+def list_unpartitioned(bucket, client=None):
+    """
+    List the objects at the top of a bucket, outside the partitions:
+    logs written there by CDNs, and anything not yet migrated
+    """
+    return list_s3_objects(bucket, client=client, delimiter='/')
+
+def open_s3_object(bucket, key, max_buffer=0, client=None):
+    """
+    Open an S3 object for reading, without a temporary file
+    :arg bucket
+    :arg key
+    :arg max_buffer: objects up to this many bytes are read into memory now,
+        so the download can happen ahead of time in another thread.
+        Larger objects are returned as the unread streaming body.
+    :arg client: optional boto3 client (defaults to get_s3_client())
+    :returns binary file object
+    """
+    if client is None:
+        client = get_s3_client()
+    response = client.get_object(Bucket=bucket, Key=key)
+    body = response['Body']
+    if response['ContentLength'] <= max_buffer:
+        data = body.read()
+        body.close()
+        return io.BytesIO(data)
+    return body
+
+def read_s3_head(bucket, key, size, client=None):
+    """
+    Read the first bytes of an S3 object, with a ranged GET
+    :arg size: most bytes to read
+    :returns (bytes, size of the whole object)
+    """
+    if client is None:
+        client = get_s3_client()
+    try:
+        response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{size - 1}")
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+            # empty object, there's no byte 0
+            return b'', 0
+        raise
+    body = response['Body']
+    try:
+        data = body.read()
+    finally:
+        body.close()
+    # ContentRange is 'bytes 0-<last>/<size>'
+    content_range = response.get('ContentRange')
+    total = int(content_range.rsplit('/', 1)[1]) if content_range else len(data)
+    return data, total
+
+def prefetch(function, items, depth):
+    """
+    Run function over items in a thread pool, staying at most depth
+    items ahead of the consumer
+    :yields (item, future) in the order of items
+    """
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(depth, 1)) as pool:
+        for item in itertools.islice(items, max(depth, 1)):
+            pending.append((item, pool.submit(function, item)))
+        while pending:
+            item, future = pending.popleft()
+            yield item, future
+            # only fetch the next one once this one is consumed, so no more
+            # than depth objects are held at once
+            for next_item in itertools.islice(items, 1):
+                pending.append((next_item, pool.submit(function, next_item)))